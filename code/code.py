@@ -1,10 +1,16 @@
 import wifi, socketpool, time, alarm, rtc
 import adafruit_requests
-import adafruit_minimqtt.adafruit_minimqtt as MQTT
+import asyncio
+import async_minimqtt as MQTT
 from core.radio_helpers import mqtt_message, connected, subscribe, GS
+from core.diversity import DiversityCombiner
+from core.spool import Spool
+from core.scheduler import PowerScheduler, DEEP, LIGHT, LISTEN
+from core.passes import PassPredictor, Station
+from core.doppler import DopplerTracker
 from secrets import secrets
 from gs_config import config
-import storage, os, board, json
+import board, json
 from binascii import hexlify
 import time
 
@@ -14,13 +20,18 @@ SAT = GS.SATELLITE[config['SAT']]
 DATA_TOPIC = secrets['data']
 STATUS_TOPIC =  secrets['status'] + ID
 REMOTE_TOPIC =  secrets['remote'] + ID
+SCHEDULER = PowerScheduler(interval=600)
+if 'LOCATION' in config:
+    # TLEs come in over MQTT (TLE command), one file per satellite
+    GS.predictor = PassPredictor(Station(*config['LOCATION']), '/{}.tle'.format(SAT['NAME']))
 
-def synctime(pool):
+def synctime(pool, retries=None):
     try:
         requests = adafruit_requests.Session(pool)
         TIME_API = "http://worldtimeapi.org/api/ip"
         the_rtc = rtc.RTC()
         response = None
+        tries = 0
         while True:
             try:
                 print("Fetching time")
@@ -28,6 +39,9 @@ def synctime(pool):
                 response = requests.get(TIME_API)
                 break
             except (ValueError, RuntimeError) as e:
+                tries += 1
+                if retries is not None and tries >= retries:
+                    raise
                 print("Failed to get data, retrying\n", e)
                 continue
 
@@ -50,30 +64,46 @@ def synctime(pool):
     except Exception as e:
         print('[WARNING]', e)
 
-def attempt_wifi():
+def attempt_wifi(timeout=None, sync_retries=None):
     # TODO: Move wifi pass and id to config
-    # try connecting to wifi
+    # try connecting to wifi, timeout and sync_retries bound how long this
+    # can block (None: the defaults, retry the time sync until it works)
     print("Connecting to WiFi...")
     try:
-        wifi.radio.connect(ssid=secrets['homeSSID'], password=secrets['homePass'])
+        wifi.radio.connect(ssid=secrets['homeSSID'], password=secrets['homePass'], timeout=timeout)
         #wifi.radio.connect(ssid="Stanford") # open network
         print("Signal: {}".format(wifi.radio.ap_info.rssi))
         # Create a socket pool
         pool = socketpool.SocketPool(wifi.radio)
         # sync out RTC from the web
-        synctime(pool)
+        synctime(pool, sync_retries)
     except Exception as e:
         print("Unable to connect to WiFi: {}".format(e))
         return None
     else:
         return pool
 
-def get_new_messages():
+def make_message(frame, new=True):
+    # radio, time, gs id, msg, rssi, new?
+    return {
+        "Radio": frame.radio,
+        "Radios": frame.radios,
+        "Time": frame.time,
+        "ID": ID,
+        "Hexlify MSG": hexlify(frame.data),
+        "Bytes MSG": str(frame.data),
+        "RSSI": frame.rssi,
+        "N": 1 if new else 0,
+    }
+
+def get_new_frames():
     '''
     Req: Must be called before radios are initialized, otherwise will fail
     '''
-    new_messages = {}
+    new_frames = []
     if alarm.wake_alarm:
+        # the same frame often lands on several antennas, keep the best copy
+        combiner = DiversityCombiner(stats=GS.rx_stats)
         # hacky way of checking the radios without initalizing the hardware
         for r, cs in GS.radios.items(): # This uses a temporary list
             if GS.rx_done(cs):
@@ -81,38 +111,77 @@ def get_new_messages():
                 for msg in GS.get_msg2(cs):
                     if msg is not None:
                         print("[{}] rssi:{}".format(bytes(msg), GS.last_rssi), end=", ")
-                        if (msg == b'CRC ERROR'):
+                        if not GS.last_crc_ok:
                             print("Failed crc check")
-                            continue
                         else:
-                            # radio, time, gs id, msg, rssi, new?
-                            new_messages[r] = {
-                                "Radio": r,
-                                "Time": time.time(),
-                                "ID": ID,
-                                "Hexlify MSG": hexlify(msg),
-                                "Bytes MSG": str(bytes(msg)),
-                                "RSSI": GS.last_rssi,
-                                "N": 1,
-                            }
-                            print(new_messages[r])
                             print("passes crc check")
+                        combiner.add(r, msg, GS.last_rssi, GS.last_crc_ok)
                 print()
+        new_frames = combiner.flush(force=True)
         print("Done checking")
         radios = GS.init_radios(SAT)
-        return new_messages
+    return new_frames
+
+def cache_frames(frames):
+    '''
+    Keep frames for the next wake with WiFi. They go to sleep memory, which
+    costs nothing, until that is full. Then everything moves to the flash
+    spool in one write.
+    '''
+    log = GS.sleep_log
+    for i, frame in enumerate(frames):
+        if log.append(frame):
+            continue
+        spill = log.frames() + frames[i:]
+        try:
+            Spool().append([json.dumps(make_message(f, new=False)).encode() for f in spill])
+        except Exception:
+            print("Cant cache msg. Connected to usb?")
+            frames = frames[:i]
+        else:
+            log.clear()
+        break
+    GS.msg_cache = min(255, GS.msg_cache + len(frames))
 
-def set_up_mqtt(pool):
+async def set_up_mqtt(pool):
     mqtt_client = MQTT.MQTT(
             broker=secrets["broker"],
             port=secrets["port"],
             socket_pool=pool,
-            is_ssl=False
+            # the same id every wake, so the broker can keep our session
+            client_id="pygs{}{:08x}".format(ID, GS.myuid & 0xFFFFFFFF)[:23],
+            # one TCP segment, so a batch from publish_many() is one send
+            tx_size=1460,
         )
     mqtt_client.on_connect = connected
     mqtt_client.on_message = mqtt_message
     mqtt_client.on_subscribe = subscribe
 
+    # Persistent session: the broker keeps the REMOTE_TOPIC subscription and
+    # queues commands (QoS 1) while we sleep, so a wake that finds its
+    # session skips the SUBSCRIBE round trip. The broker address is cached
+    # in sleep memory to skip DNS too, falling back to a lookup if it fails.
+    address = GS.broker_address
+    try:
+        session = await mqtt_client.connect(clean_session=False, address=address)
+    except (OSError, MQTT.MMQTTException):
+        # the cached address may belong to another host by now
+        if address is None:
+            raise
+        GS.broker_address = None
+        session = await mqtt_client.connect(clean_session=False)
+    GS.broker_address = mqtt_client.address
+    if not session:
+        try:
+            await mqtt_client.subscribe(REMOTE_TOPIC, qos=1)
+        except Exception:
+            await mqtt_client.disconnect()
+            raise
+
+    GS.mqtt_client = mqtt_client
+    await send_status()
+
+async def send_status():
     status = {
         "Time": time.time(),
         "ID": GS.id,
@@ -121,54 +190,303 @@ def set_up_mqtt(pool):
         "MSG_Cache": GS.msg_cache,
         "Battery": GS.battery_voltage,
         "WiFi_RSSI": wifi.radio.ap_info.rssi,
+        "RX": GS.rx_stats,
     }
-
-    mqtt_client.connect()
-    mqtt_client.subscribe(REMOTE_TOPIC)
-    
     print("Sending status")
     message = "GS {} status: ".format(ID) + json.dumps(status)
-    mqtt_client.publish(STATUS_TOPIC, message)
+    await GS.mqtt_client.publish(STATUS_TOPIC, message)
 
-    GS.mqtt_client = mqtt_client
+async def send_cache_messages():
+    # Flash first, it holds the older frames
+    await send_spool()
+    # then sleep memory, acknowledged batches are dropped as they go
+    log = GS.sleep_log
+    frames = log.frames()
+    for i in range(0, len(frames), 8):
+        batch = frames[i:i + 8]
+        await GS.mqtt_client.publish_many(
+            [(DATA_TOPIC, "Sending cached message: " + json.dumps(make_message(f, new=False)))
+             for f in batch], qos=1)
+        await GS.mqtt_client.flush()
+        log.drop(len(batch))
+    if not log and not Spool():
+        GS.msg_cache = 0
 
-def send_cache_messages():
-    if GS.msg_cache:
-            with open("/data.txt", "r") as f:
-                l = f.readline()
-                while l:
-                    message = "Sending cached message: " + l.strip()
-                    GS.mqtt_client.publish(DATA_TOPIC, message)
-                    l = f.readline()
-            try:
-                os.remove("/data.txt")
-            except:
-                pass
-            GS.msg_cache = 0
-
-def check_for_commands():
-    queuedUp = None
-    loopOnce = True
-    waitTime = 30
+async def send_spool():
+    # The spool is checked rather than GS.msg_cache, sleep memory doesn't
+    # survive a power cut
+    spool = Spool()
+    if not spool:
+        return
+    # Batches of QoS 1 publishes, the cursor only moves past a batch once
+    # flush() says the broker has all of it. Whatever got through is
+    # committed even if the connection drops halfway.
+    offset = spool.cursor
+    try:
+        while True:
+            records, end = spool.read(offset, 8)
+            if not records:
+                # only a torn or corrupt tail left, move past it so
+                # commit() can drop the file
+                offset = end
+                break
+            await GS.mqtt_client.publish_many(
+                [(DATA_TOPIC, b"Sending cached message: " + r) for r in records], qos=1)
+            await GS.mqtt_client.flush()
+            offset = end
+            GS.msg_cache = max(0, GS.msg_cache - len(records))
+    finally:
+        try:
+            spool.commit(offset)
+        except Exception as e:
+            print("Cant update cache: {}".format(e))
+    if spool.dropped:
+        print("Dropped {} corrupt cached messages".format(spool.dropped))
+
+async def send_messages(msgs):
+    batch = []
+    for msg in msgs:
+        print("Sending message")
+        print(msg)
+        batch.append((DATA_TOPIC, "Message received: " + json.dumps(msg)))
+    await GS.mqtt_client.publish_many(batch, qos=1)
+
+async def check_for_commands(waitTime=30):
+    '''
+    Keep the radios listening while the broker gets a chance to send us
+    commands (handled by mqtt_message on the MQTT reader task). Frames heard
+    in the meantime are published straight away, or cached if the broker
+    doesn't acknowledge them.
+    '''
     print("Waiting {} seconds for commands to be sent to ground station before processing".format(waitTime))
-    GS.mqtt_client.publish(REMOTE_TOPIC, "Waiting {} seconds for commands to be sent to ground station before processing".format(waitTime))
-    time.sleep(waitTime)
+    await GS.mqtt_client.publish(REMOTE_TOPIC, "Waiting {} seconds for commands to be sent to ground station before processing".format(waitTime))
+
+    combiner = DiversityCombiner(stats=GS.rx_stats)
+    queue = GS.start_rx()
+    try:
+        end = time.monotonic() + waitTime
+        while time.monotonic() < end and GS.mqtt_client.is_connected:
+            packet = queue.get_nowait()
+            if packet is not None:
+                combiner.add(packet.radio, packet.data, packet.rssi, packet.crc_ok)
+                continue
+            frames = combiner.flush()
+            if frames:
+                GS.msg_count = GS.msg_count + len(frames)
+                await forward(frames)
+            await asyncio.sleep_ms(100)
+        frames = combiner.flush(force=True)
+        if frames:
+            GS.msg_count = GS.msg_count + len(frames)
+            await forward(frames)
+    finally:
+        GS.stop_rx()
+    print("Done waiting for commands")
 
-    # Loop through commands
-    while loopOnce or queuedUp != None:
-        loopOnce = False
+async def online(pool, new_frames):
+    '''
+    Send the cache and new_frames, then wait for commands. If anything
+    fails before the broker has acknowledged new_frames they are cached
+    and the error is raised.
+    '''
+    unsent = new_frames
+    try:
+        # Set up the MQTT client
+        await set_up_mqtt(pool)
         try:
-            #Grab next command
-            queuedUp = GS.mqtt_client.loop()
-        except:
-            print("Error on mqtt loop")
-        else:
-            print(queuedUp)
-        time.sleep(2)
+            # send any cached messages
+            await send_cache_messages()
+
+            # send any new messages
+            if new_frames:
+                await send_messages([make_message(frame) for frame in new_frames])
+                await GS.mqtt_client.flush(timeout=10)
+            unsent = []
+
+            # check for mqtt remote messages
+            await check_for_commands()
+            await GS.mqtt_client.flush()
+        finally:
+            await GS.mqtt_client.disconnect()
+    except Exception:
+        if unsent:
+            cache_frames(unsent)
+        raise
+
+async def forward(frames):
+    '''
+    Publish frames and wait for the broker to have them. If that fails they
+    are cached, the connection is dropped and False is returned.
+    '''
+    try:
+        await send_messages([make_message(frame) for frame in frames])
+        await GS.mqtt_client.flush(timeout=10)
+        return True
+    except Exception as e:
+        print("Caching {} messages: {}".format(len(frames), e))
+        cache_frames(frames)
+        await GS.mqtt_client.disconnect()
+        return False
+
+def doppler_tracker(now):
+    '''
+    Doppler table for the pass under way (from the scheduler's margin
+    before it), None between passes or without a TLE.
+    '''
+    if GS.predictor is None or not config.get('DOPPLER', True):
+        return None
+    for aos, los in GS.passes:
+        if aos - SCHEDULER.margin <= now < los:
+            orbit = GS.predictor.orbit()
+            if orbit is None:
+                return None
+            print("Tracking Doppler for {}s".format(int(los - now)))
+            return DopplerTracker.for_pass(GS.radios, SAT['FREQ'], orbit, GS.predictor.station,
+                                           aos - SCHEDULER.margin, los, bw=SAT['BW'])
+    return None
+
+async def listen_forever(pool, new_frames, duration=None):
+    '''
+    Radios, WiFi and MQTT stay up and frames are published as they arrive,
+    for duration seconds or, in listen mode (mains powered stations), for
+    good. Frames heard while the broker can't be reached are cached as in
+    sleep mode and sent once it can. A status message goes out every
+    GS.deep_sleep seconds. During a pass the radios follow the Doppler
+    shift.
+    '''
+    # all antennas hear a frame at the same time, no need for a long window
+    combiner = DiversityCombiner(window=0.2, stats=GS.rx_stats)
+    queue = GS.start_rx(maxlen=32)
+    frames = new_frames
+    up = False
+    retry = 0
+    backoff = 5
+    status = time.monotonic() + GS.deep_sleep
+    until = None if duration is None else time.monotonic() + duration
+    GS.update_passes()
+    tracker = None
+    try:
+        while until is None or time.monotonic() < until:
+            now = time.time()
+            if tracker is None:
+                tracker = doppler_tracker(now)
+            elif not tracker.update(now):
+                tracker.restore()
+                tracker = None
+
+            packet = queue.get_nowait()
+            if packet is not None:
+                combiner.add(packet.radio, packet.data, packet.rssi, packet.crc_ok)
+                continue
+            heard = combiner.flush()
+            if heard:
+                GS.msg_count = GS.msg_count + len(heard)
+                frames = frames + heard
+
+            up = up and GS.mqtt_client.is_connected
+            if not up and time.monotonic() >= retry:
+                try:
+                    if pool is None or wifi.radio.ap_info is None:
+                        # this blocks the loop, so one short try per backoff
+                        # step. The radios stay in RX meanwhile and the
+                        # listeners pick up what they heard afterwards.
+                        pool = attempt_wifi(timeout=5, sync_retries=1)
+                        await asyncio.sleep_ms(0)
+                    if pool is not None:
+                        await set_up_mqtt(pool)
+                        up = True
+                        await send_cache_messages()
+                        backoff = 5
+                except Exception as e:
+                    print("Can't reach the broker: {}".format(e))
+                    up = False
+                    if GS.mqtt_client is not None:
+                        await GS.mqtt_client.disconnect()
+                if not up:
+                    retry = time.monotonic() + backoff
+                    backoff = min(2 * backoff, 300)
+
+            if frames:
+                if up:
+                    up = await forward(frames)
+                else:
+                    cache_frames(frames)
+                frames = []
+
+            if up and time.monotonic() >= status:
+                status = time.monotonic() + GS.deep_sleep
+                GS.counter = GS.counter + 1
+                GS.update_passes()
+                try:
+                    await send_status()
+                except Exception as e:
+                    print("Status failed: {}".format(e))
+            await asyncio.sleep_ms(10)
+
+        # time's up, whatever is still being merged goes out now
+        heard = combiner.flush(force=True)
+        if heard:
+            GS.msg_count = GS.msg_count + len(heard)
+            frames = frames + heard
+        if frames:
+            if up:
+                up = await forward(frames)
+            else:
+                cache_frames(frames)
+    finally:
+        if tracker is not None:
+            tracker.restore()
+        GS.stop_rx()
+        if up:
+            await GS.mqtt_client.disconnect()
+
+def read_radios():
+    '''
+    Frames waiting in the radios after a light sleep. Unlike a deep sleep
+    wake (get_new_frames) the radios are still set up.
+    '''
+    combiner = DiversityCombiner(stats=GS.rx_stats)
+    for radio in GS.radios:
+        if radio.rx_done():
+            # unfiltered and left in RX, as the listeners and get_msg2 do
+            msg, crc_ok = radio.read_fifo()
+            if msg is not None:
+                combiner.add(radio.name, msg, radio.last_rssi - 164, crc_ok)
+    return combiner.flush(force=True)
+
+def plan_sleep():
+    '''
+    Ask the scheduler what to do until the next wake. Updates the packet
+    rate (from msg_count, once SCHEDULER.window has passed) and
+    GS.deep_sleep, the timer.
+    '''
+    now = time.time()
+    if not GS.last_wake or now < GS.last_wake:
+        # first run, or the clock was set back: start counting from here
+        GS.last_wake = now
+        GS.rate_mark = GS.msg_count
+    rate = SCHEDULER.rate(GS.packet_rate, (GS.msg_count - GS.rate_mark) % 65536, now - GS.last_wake)
+    if rate is not None:
+        GS.packet_rate = rate
+        GS.rate_mark = GS.msg_count
+        GS.last_wake = now
+    mode, GS.deep_sleep = SCHEDULER.plan(now, GS.battery_voltage, GS.packet_rate, GS.update_passes())
+    print("Scheduler: {} for {}s ({:.1f} frames/h)".format(mode, GS.deep_sleep, GS.packet_rate))
+    return mode
+
+def wake_alarms():
+    # wake up on IRQ or after deep sleep time
+    # TODO: Make this actually loop through radios so its not a hard 3. Moreover, set the pin number to be set with the radios above
+    pin_alarm1 = alarm.pin.PinAlarm(pin=board.IO5, value=True, pull=False)  # radio1
+    pin_alarm2 = alarm.pin.PinAlarm(pin=board.IO6, value=True, pull=False)  # radio2
+    pin_alarm3 = alarm.pin.PinAlarm(pin=board.IO7, value=True, pull=False)  # radio3
+    time_alarm = alarm.time.TimeAlarm(monotonic_time=time.monotonic() + GS.deep_sleep)
+    return (time_alarm, pin_alarm1, pin_alarm2, pin_alarm3)
 
 def main():
     
     GS.id = ID
+    mode = config.get('MODE', 'sleep')
 
     # if we haven't slept yet, init radios
     if not alarm.wake_alarm:
@@ -179,6 +497,10 @@ def main():
         GS.msg_count = 0
         GS.msg_cache = 0
         GS.deep_sleep = 600
+        GS.broker_address = None
+        GS.last_wake = 0
+        GS.rate_mark = 0
+        GS.packet_rate = 0
     else:
         # Temporary radio list
         # TODO move this to _init_ in GS class, and make sure its not hard coded
@@ -195,58 +517,49 @@ def main():
     pool = attempt_wifi()
 
     # check radios (And initializes them)
-    new_messages = get_new_messages()
+    new_frames = get_new_frames()
 
-    if new_messages:
-        GS.msg_count = GS.msg_count + 1
+    # light sleep and timed listening come back here, deep sleep reboots
+    while True:
+        if new_frames:
+            GS.msg_count = GS.msg_count + 1
 
-    # if we have wifi, connect to mqtt broker
-    if wifi.radio.ap_info is not None:
-        # try:1069855917
+        if mode == 'listen':
+            # never returns, the radios stay up instead of deep sleeping
+            asyncio.run(listen_forever(pool, new_frames))
 
-        # Set up a MiniMQTT Client
-        set_up_mqtt(pool)
+        # if we have wifi, connect to mqtt broker
+        if wifi.radio.ap_info is not None:
+            try:
+                asyncio.run(online(pool, new_frames))
+            except Exception as e:
+                # online() has cached what the broker didn't get, sleep anyway
+                print("MQTT failed: {}".format(e))
 
-        # send any cached messages
-        send_cache_messages()
+        # if we can't connect, cache the frames
+        elif new_frames:
+            cache_frames(new_frames)
 
-        # send any new messages
-        if new_messages:
-            for msg in new_messages:
-                print("Sending message")
-                print(new_messages[msg])
-                #mqtt_client.publish(DATA_TOPIC, new_messages[msg])
-                message = "Message received: " + json.dumps(new_messages[msg])
-                GS.mqtt_client.publish(DATA_TOPIC, message)
+        GS.counter = GS.counter + 1
+        sleep = plan_sleep() if mode == 'auto' else DEEP
 
-        # check for mqtt remote messages
-        check_for_commands()
+        if sleep == LISTEN:
+            print("Pass in progress, listening for {}s...".format(GS.deep_sleep))
+            asyncio.run(listen_forever(pool, [], GS.deep_sleep))
+            new_frames = []
+            continue
 
-        GS.mqtt_client.disconnect()
+        GS.gs_listen()
+        if sleep == LIGHT:
+            print("Light sleep until RX interrupt or {}s timeout...".format(GS.deep_sleep))
+            alarm.light_sleep_until_alarms(*wake_alarms())
+            new_frames = read_radios()
+            if wifi.radio.ap_info is None:
+                pool = attempt_wifi()
+            continue
 
-    # if we can't connect, cache message
-    else:
-        for msg in new_messages:
-            new_messages[msg]["N"] = 0  # not new
-            try:
-                storage.remount("/", False)
-                with open("/data.txt", "a") as f:
-                    f.write(json.dumps(new_messages[msg]) + "\n")
-                storage.remount("/", True)
-            except:
-                print("Cant cache msg. Connected to usb?")
-            GS.msg_cache = GS.msg_cache + 1
-
-    GS.counter = GS.counter + 1
-    GS.gs_listen()
-    print("Finished. Deep sleep until RX interrupt or {}s timeout...".format(GS.deep_sleep))
-    # wake up on IRQ or after deep sleep time
-    # TODO: Make this actually loop through radios so its not a hard 3. Moreover, set the pin number to be set with the radios above
-    pin_alarm1 = alarm.pin.PinAlarm(pin=board.IO5, value=True, pull=False)  # radio1
-    pin_alarm2 = alarm.pin.PinAlarm(pin=board.IO6, value=True, pull=False)  # radio2
-    pin_alarm3 = alarm.pin.PinAlarm(pin=board.IO7, value=True, pull=False)  # radio3
-    time_alarm = alarm.time.TimeAlarm(monotonic_time=time.monotonic() + GS.deep_sleep)
-    alarm.exit_and_deep_sleep_until_alarms(time_alarm, pin_alarm1, pin_alarm2, pin_alarm3)
+        print("Finished. Deep sleep until RX interrupt or {}s timeout...".format(GS.deep_sleep))
+        alarm.exit_and_deep_sleep_until_alarms(*wake_alarms())
 
 if __name__ == '__main__':
     main()
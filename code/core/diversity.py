@@ -0,0 +1,114 @@
+import time
+from binascii import crc32
+from collections import namedtuple
+
+# A frame after merging the copies heard by each radio
+#   data: payload of the best copy
+#   radio: radio that heard the best copy
+#   rssi: RSSI of the best copy
+#   radios: every radio that heard the frame
+#   crc_ok: False only if no radio got a clean copy
+#   time: time.time() of the first copy
+Frame = namedtuple('Frame', ('data', 'radio', 'rssi', 'radios', 'crc_ok', 'time'))
+
+# Pending entry fields
+_DATA = 0
+_RADIO = 1
+_RSSI = 2
+_RADIOS = 3
+_CRC_OK = 4
+_TIME = 5
+_SEEN = 6
+
+
+class DiversityCombiner:
+    '''
+    Merges copies of the same downlink frame heard by several antennas.
+
+    Copies are matched on a CRC32 of the payload and merged if they arrive
+    within `window` seconds of the first one. A corrupt copy hashes
+    differently from the clean one, so it is paired with a frame of the same
+    length from another radio in the window instead. The kept copy is the
+    CRC-valid one with the best RSSI. Per-radio statistics are kept in `stats`:
+    radio -> [frames heard, times it had the best copy, CRC errors]. Pass
+    a dict in to keep counting across combiners. Frames no radio got a
+    clean copy of are counted but only returned if keep_corrupt.
+    '''
+
+    def __init__(self, window=1.0, stats=None, keep_corrupt=False):
+        self.window = window
+        self.keep_corrupt = keep_corrupt
+        self._pending = {}
+        self._emit = []
+        self.stats = {} if stats is None else stats
+
+    def add(self, radio, data, rssi, crc_ok=True):
+        '''
+        Record one received copy. data may be a view into a shared buffer,
+        it is copied only if it becomes the kept copy.
+        '''
+        now = time.monotonic()
+        key = crc32(data)
+        stat = self.stats.get(radio)
+        if stat is None:
+            stat = self.stats[radio] = [0, 0, 0]
+        stat[0] += 1
+        if not crc_ok:
+            stat[2] += 1
+
+        entry = self._pending.get(key)
+        if entry is None:
+            match = self._match(data, radio, crc_ok, now)
+            if match is not None:
+                entry = self._pending[match]
+                if crc_ok:
+                    # file it under the clean payload for the copies to come
+                    del self._pending[match]
+                    self._pending[key] = entry
+        if entry is None or now - entry[_SEEN] > self.window:
+            if entry is not None:
+                # same payload again after the window: a new frame
+                self._finish(entry, self._emit)
+            self._pending[key] = [bytes(data), radio, rssi, [radio], crc_ok, time.time(), now]
+            return
+        if radio not in entry[_RADIOS]:
+            entry[_RADIOS].append(radio)
+        # a clean copy beats a corrupt one, then the stronger one wins
+        if (crc_ok and not entry[_CRC_OK]) or (crc_ok == entry[_CRC_OK] and rssi > entry[_RSSI]):
+            entry[_DATA] = bytes(data)
+            entry[_RADIO] = radio
+            entry[_RSSI] = rssi
+            entry[_CRC_OK] = crc_ok
+
+    def _match(self, data, radio, crc_ok, now):
+        '''Key of the pending frame a copy that didn't hash to one belongs to'''
+        for key, entry in self._pending.items():
+            if ((not crc_ok or not entry[_CRC_OK]) and radio not in entry[_RADIOS]
+                    and len(entry[_DATA]) == len(data) and now - entry[_SEEN] <= self.window):
+                return key
+        return None
+
+    def flush(self, force=False):
+        '''
+        Return the merged frames whose window has closed (all of them if
+        force), oldest first.
+        '''
+        now = time.monotonic()
+        frames = self._emit
+        self._emit = []
+        for key in list(self._pending):
+            entry = self._pending[key]
+            if force or now - entry[_SEEN] > self.window:
+                del self._pending[key]
+                self._finish(entry, frames)
+        frames.sort(key=lambda f: f.time)
+        return frames
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _finish(self, entry, frames):
+        if entry[_CRC_OK] or self.keep_corrupt:
+            self.stats[entry[_RADIO]][1] += 1
+            frames.append(Frame(entry[_DATA], entry[_RADIO], entry[_RSSI], tuple(entry[_RADIOS]),
+                                entry[_CRC_OK], entry[_TIME]))
@@ -0,0 +1,77 @@
+from array import array
+from core.frequency import FrequencyPlan, frf
+from pycubed_rfm9x import _RH_RF95_FSTEP
+
+
+class DopplerTracker:
+    '''
+    Keeps the radios centred on a satellite's downlink during a pass.
+
+    The frequency vs time table is worked out once, before the pass, and
+    only holds the times the error would grow past `tolerance` (a fraction
+    of the bandwidth, LoRa copes with far more), so there are a handful of
+    retunes per pass rather than one every FRF step. `update()` is then
+    cheap enough for the receive loop: it moves along the table and retunes
+    a radio only when its FRF value is out of date and it isn't in the
+    middle of a packet, which a retune would lose. A deferred retune is
+    tried again on the next update. Times are time.time().
+    '''
+
+    def __init__(self, radios, freq_mhz, times, plan, end):
+        self.radios = radios
+        self.center = frf(freq_mhz)
+        self.times = times
+        self.plan = plan
+        self.end = end
+        self._i = 0
+        self._tuned = {}
+
+    @classmethod
+    def for_pass(cls, radios, freq_mhz, orbit, station, aos, los, step=5, bw=125000, tolerance=0.05):
+        '''
+        Table for the pass aos to los, sampling the Doppler every step
+        seconds. Retunes once the error passes tolerance * bw Hz.
+        '''
+        freq = freq_mhz * 1000000
+        slack = int(tolerance * bw / _RH_RF95_FSTEP)
+        # offsets in FRF steps from the centre, single precision floats
+        # can't hold 437 MHz to the step
+        center = frf(freq_mhz)
+        times = array('L')
+        plan = FrequencyPlan()
+        t = int(aos)
+        los = int(los)
+        while True:
+            value = center + round(station.doppler(orbit, t, freq) / _RH_RF95_FSTEP)
+            if not len(plan) or abs(value - plan[-1]) > slack:
+                times.append(t)
+                plan.append(value)
+            if t >= los:
+                break
+            t = min(t + step, los)
+        return cls(radios, freq_mhz, times, plan, los)
+
+    def _tune(self, value, wait=True):
+        for radio in self.radios:
+            if self._tuned.get(radio.name) == value:
+                continue
+            if wait and radio.receiving():
+                continue
+            radio.frf = value
+            self._tuned[radio.name] = value
+
+    def update(self, now):
+        '''Retune for time now. Returns False once the pass is over.'''
+        times = self.times
+        if not len(times) or now < times[0]:
+            return True
+        i = self._i
+        while i + 1 < len(times) and times[i + 1] <= now:
+            i += 1
+        self._i = i
+        self._tune(self.plan[i])
+        return now < self.end
+
+    def restore(self):
+        '''Back to the nominal frequency, for between passes'''
+        self._tune(self.center, wait=False)
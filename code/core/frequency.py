@@ -0,0 +1,41 @@
+from array import array
+from pycubed_rfm9x import _RH_RF95_FSTEP
+
+
+def frf(freq_mhz):
+    '''
+    24-bit FRF register value for freq_mhz, worked out exactly as
+    RFM9x.frequency_mhz does so the two always agree
+    '''
+    return int((freq_mhz * 1000000.0) / _RH_RF95_FSTEP) & 0xFFFFFF
+
+
+class FrequencyPlan:
+    '''
+    FRF register values worked out once, so retuning is an array lookup and
+    one 3 byte SPI burst (RFM9x.frf) instead of float math and three
+    register writes. Holds a set of channels for hopping, or the points of
+    a Doppler curve, 4 bytes each in an array('L').
+    '''
+
+    def __init__(self, frfs=()):
+        self.frfs = array('L', frfs)
+
+    @classmethod
+    def channels(cls, freqs_mhz):
+        return cls([frf(f) for f in freqs_mhz])
+
+    def __len__(self):
+        return len(self.frfs)
+
+    def __getitem__(self, i):
+        return self.frfs[i]
+
+    def append(self, value):
+        self.frfs.append(value)
+
+    def tune(self, radios, i):
+        '''Put every radio on entry i'''
+        value = self.frfs[i]
+        for radio in radios:
+            radio.frf = value
@@ -0,0 +1,328 @@
+import json
+import math
+import os
+import storage
+from binascii import crc32
+
+# WGS-72, as used for TLEs
+_RE = 6378.135          # km
+_MU = 398600.8          # km^3/s^2
+_J2 = 0.001082616
+_KE = 0.0743669161      # sqrt(GM) in earth radii^1.5/min
+_FLAT = 1 / 298.26
+_OMEGA = 7.292115e-5    # earth rotation, rad/s
+_C = 299792.458         # km/s
+_J2000 = 946728000      # 2000-01-01 12:00 UTC as a unix time
+_TWOPI = 2 * math.pi
+_RAD = math.pi / 180
+
+
+def _days_from_civil(y, m, d):
+    # days since 1970-01-01
+    y -= m <= 2
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * (m + (-3 if m > 2 else 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def _checksum(line):
+    total = 0
+    for c in line[:68]:
+        if c.isdigit():
+            total += int(c)
+        elif c == '-':
+            total += 1
+    return total % 10 == int(line[68])
+
+
+def _float(field):
+    # TLE style '12345-4' = 0.12345e-4
+    field = field.strip()
+    if not field:
+        return 0.0
+    sign = -1 if field[0] == '-' else 1
+    field = field.lstrip('+-')
+    if '-' in field[1:] or '+' in field[1:]:
+        i = max(field.rfind('-'), field.rfind('+'))
+        return sign * float('0.' + field[:i]) * 10 ** int(field[i:])
+    return sign * float(field)
+
+
+class Orbit:
+    '''
+    Propagates a TLE with an "SGP4 lite" model: Kepler orbit with the J2
+    secular drift of the node, perigee and mean anomaly, and the TLE's
+    ndot/2 term for drag. Good to a few km a few days from the epoch,
+    plenty for AOS/LOS to within a few seconds.
+
+    Times are unix seconds (ints on the board, floats stay small by always
+    working relative to the epoch).
+    '''
+
+    def __init__(self, line1, line2):
+        line1 = line1.strip()
+        line2 = line2.strip()
+        if not (line1[:2] == '1 ' and line2[:2] == '2 ' and len(line1) >= 69 and len(line2) >= 69):
+            raise ValueError('not a TLE')
+        if not (_checksum(line1) and _checksum(line2)):
+            raise ValueError('TLE checksum')
+        self.lines = (line1, line2)
+        self.crc = crc32((line1 + line2).encode())
+
+        year = int(line1[18:20])
+        year += 2000 if year < 57 else 1900
+        day, _, frac = line1[20:32].strip().partition('.')
+        self.epoch = (_days_from_civil(year, 1, 1) + int(day) - 1) * 86400 \
+            + int(float('0.' + (frac or '0')) * 86400 + 0.5)
+        ndot2 = _float(line1[33:43])
+
+        i = float(line2[8:16]) * _RAD
+        self.raan0 = float(line2[17:25]) * _RAD
+        e = float('0.' + line2[26:33])
+        self.argp0 = float(line2[34:42]) * _RAD
+        self.m0 = float(line2[43:51]) * _RAD
+        n = float(line2[52:63]) * _TWOPI / 1440  # rad/min
+
+        # Brouwer mean motion and semi-major axis, as SGP4 does
+        cosi = math.cos(i)
+        k = 0.75 * _J2 * (3 * cosi * cosi - 1) / (1 - e * e) ** 1.5
+        a1 = (_KE / n) ** (2 / 3)
+        d1 = k / (a1 * a1)
+        a0 = a1 * (1 - d1 / 3 - d1 * d1 - 134 / 81 * d1 * d1 * d1)
+        d0 = k / (a0 * a0)
+        self.n = n / (1 + d0)
+        self.a = a0 / (1 - d0)
+
+        p = self.a * (1 - e * e)
+        self.raan_dot = -1.5 * _J2 * self.n * cosi / (p * p)
+        self.argp_dot = 0.75 * _J2 * self.n * (5 * cosi * cosi - 1) / (p * p)
+        self.m_dot = self.n * (1 + 0.75 * _J2 * math.sqrt(1 - e * e) * (3 * cosi * cosi - 1) / (p * p))
+        self.ndot = ndot2 * _TWOPI / (1440 * 1440)  # rad/min^2
+        self.e = e
+        self.sini = math.sin(i)
+        self.cosi = cosi
+
+    def state(self, t):
+        '''ECI position (km) and velocity (km/s) at unix time t'''
+        dt = (t - self.epoch) / 60
+        e = self.e
+        m = (self.m0 + self.m_dot * dt + self.ndot * dt * dt) % _TWOPI
+        # drag shrinks the orbit as the mean motion goes up
+        n = self.n + 2 * self.ndot * dt
+        a = self.a * (self.n / n) ** (2 / 3) * _RE
+        raan = self.raan0 + self.raan_dot * dt
+        argp = self.argp0 + self.argp_dot * dt
+
+        E = m
+        for _ in range(8):
+            step = (E - e * math.sin(E) - m) / (1 - e * math.cos(E))
+            E -= step
+            if abs(step) < 1e-7:
+                break
+        cosE = math.cos(E)
+        sinE = math.sin(E)
+        root = math.sqrt(1 - e * e)
+        # perifocal position and velocity
+        px = a * (cosE - e)
+        py = a * root * sinE
+        r = a * (1 - e * cosE)
+        v = math.sqrt(_MU * a) / r
+        vx = -v * sinE
+        vy = v * root * cosE
+
+        cO, sO = math.cos(raan), math.sin(raan)
+        cw, sw = math.cos(argp), math.sin(argp)
+        ci, si = self.cosi, self.sini
+        # rotation perifocal -> ECI, first two columns
+        r11 = cO * cw - sO * sw * ci
+        r12 = -cO * sw - sO * cw * ci
+        r21 = sO * cw + cO * sw * ci
+        r22 = -sO * sw + cO * cw * ci
+        r31 = sw * si
+        r32 = cw * si
+        return ((r11 * px + r12 * py, r21 * px + r22 * py, r31 * px + r32 * py),
+                (r11 * vx + r12 * vy, r21 * vx + r22 * vy, r31 * vx + r32 * vy))
+
+
+def gmst(t):
+    '''Greenwich sidereal angle (rad) at unix time t'''
+    # 360.9856...deg per day, split so the whole turns (360 * days) never
+    # make it into a single precision float
+    days, seconds = divmod(int(t) - _J2000, 86400)
+    frac = (seconds + (t - int(t))) / 86400
+    deg = 280.46061837 + 360 * frac + 0.98564736629 * (days + frac)
+    return (deg % 360) * _RAD
+
+
+class Station:
+    '''Observer at lat, lon (degrees) and alt (m)'''
+
+    def __init__(self, lat, lon, alt=0):
+        lat *= _RAD
+        lon *= _RAD
+        self.lon = lon
+        e2 = _FLAT * (2 - _FLAT)
+        s = math.sin(lat)
+        c = math.cos(lat)
+        n = _RE / math.sqrt(1 - e2 * s * s)
+        h = alt / 1000
+        # ECEF position and local up
+        self.pos = ((n + h) * c * math.cos(lon), (n + h) * c * math.sin(lon), (n * (1 - e2) + h) * s)
+        self.up = (c * math.cos(lon), c * math.sin(lon), s)
+
+    def look(self, orbit, t):
+        '''(elevation in degrees, range in km, range rate in km/s) at t'''
+        (x, y, z), (vx, vy, vz) = orbit.state(t)
+        th = gmst(t)
+        c, s = math.cos(th), math.sin(th)
+        xe = c * x + s * y
+        ye = -s * x + c * y
+        # velocity relative to the rotating earth
+        vxe = c * vx + s * vy + _OMEGA * ye
+        vye = -s * vx + c * vy - _OMEGA * xe
+        dx = xe - self.pos[0]
+        dy = ye - self.pos[1]
+        dz = z - self.pos[2]
+        rng = math.sqrt(dx * dx + dy * dy + dz * dz)
+        up = (dx * self.up[0] + dy * self.up[1] + dz * self.up[2]) / rng
+        rate = (dx * vxe + dy * vye + dz * vz) / rng
+        return math.asin(max(-1, min(1, up))) / _RAD, rng, rate
+
+    def doppler(self, orbit, t, freq):
+        '''Frequency offset (same unit as freq) the station sees at t'''
+        return -self.look(orbit, t)[2] / _C * freq
+
+
+def find_passes(orbit, station, start, hours=24, min_el=0, step=60):
+    '''
+    [aos, los, max elevation] for each pass above min_el between start and
+    hours later. Scans every step seconds and bisects the horizon crossings
+    to the second, so passes shorter than step can be missed.
+    '''
+    def above(t):
+        return station.look(orbit, t)[0] - min_el
+
+    def crossing(lo, hi):
+        # above(lo) and above(hi) have different signs
+        rising = above(lo) < 0
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if (above(mid) >= 0) == rising:
+                hi = mid
+            else:
+                lo = mid
+        return hi if rising else lo
+
+    start = int(start)
+    end = start + int(hours * 3600)
+    passes = []
+    t = start
+    prev = above(t)
+    aos = start if prev >= 0 else None
+    peak = prev
+    while t < end:
+        nxt = min(t + step, end)
+        el = above(nxt)
+        if aos is None and el >= 0:
+            aos = crossing(t, nxt)
+            peak = el
+        elif aos is not None:
+            peak = max(peak, el)
+            if el < 0:
+                passes.append([aos, crossing(t, nxt), round(peak + min_el, 1)])
+                aos = None
+        t = nxt
+    if aos is not None:
+        passes.append([aos, end, round(peak + min_el, 1)])
+    return passes
+
+
+class PassPredictor:
+    '''
+    Upcoming passes of one satellite over the station, from the TLE stored
+    in tle_path. Passes are worked out for a day at a time and cached in
+    cache_path, so a wake usually just reads a small JSON file.
+    '''
+
+    def __init__(self, station, tle_path, cache_path='/passes.json', min_el=5):
+        self.station = station
+        self.tle_path = tle_path
+        self.cache_path = cache_path
+        self.min_el = min_el
+        self._orbit = None
+        self._cache = None
+
+    def orbit(self):
+        if self._orbit is None:
+            try:
+                with open(self.tle_path, 'r') as f:
+                    lines = f.read().split('\n')
+                self._orbit = Orbit(lines[0], lines[1])
+            except (OSError, ValueError, IndexError):
+                return None
+        return self._orbit
+
+    def set_tle(self, text):
+        '''
+        Store a new TLE (the two element lines, a name line is ignored).
+        Raises ValueError if it doesn't parse and OSError if CIRCUITPY can't
+        be written.
+        '''
+        lines = [l.strip() for l in text.replace('\r', '').split('\n')]
+        lines = [l for l in lines if l[:2] in ('1 ', '2 ')]
+        if len(lines) != 2:
+            raise ValueError('expected TLE lines 1 and 2')
+        orbit = Orbit(lines[0], lines[1])
+        storage.remount('/', False)
+        try:
+            with open(self.tle_path, 'w') as f:
+                f.write('\n'.join(orbit.lines) + '\n')
+            try:
+                os.remove(self.cache_path)
+            except OSError:
+                pass
+        finally:
+            storage.remount('/', True)
+        self._orbit = orbit
+        self._cache = None
+        return orbit
+
+    def _load(self):
+        if self._cache is None:
+            try:
+                with open(self.cache_path, 'r') as f:
+                    self._cache = json.load(f)
+            except (OSError, ValueError):
+                self._cache = {}
+        return self._cache
+
+    def passes(self, now):
+        '''[aos, los, max elevation] of passes not over yet, soonest first'''
+        orbit = self.orbit()
+        if orbit is None:
+            return []
+        now = int(now)
+        if now < orbit.epoch - 30 * 86400:
+            # clock not set yet (or a very stale TLE)
+            return []
+        cache = self._load()
+        if cache.get('tle') != orbit.crc or not cache.get('from', 0) <= now < cache.get('from', 0) + 86400:
+            # a day, plus enough to see the end of a pass and the next one
+            cache = self._cache = {
+                'tle': orbit.crc,
+                'from': now,
+                'passes': find_passes(orbit, self.station, now, 27, self.min_el),
+            }
+            try:
+                storage.remount('/', False)
+                try:
+                    with open(self.cache_path, 'w') as f:
+                        json.dump(cache, f)
+                finally:
+                    storage.remount('/', True)
+            except (OSError, RuntimeError) as e:
+                # kept in memory, worked out again next boot
+                print("Can't cache passes: {}".format(e))
+        return [p for p in cache['passes'] if p[1] > now]
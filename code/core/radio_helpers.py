@@ -2,15 +2,18 @@ import digitalio
 import board
 import time
 import alarm
+import asyncio
 import pycubed_rfm9x
 import adafruit_requests
 import rtc
 from microcontroller import cpu
 from analogio import AnalogIn
 from ptp import AsyncPacketTransferProtocol
-from ftp import FileTransferProtocol
+from ftp import FileTransferProtocol, Transfer
 from gs_config import config
 from core.scriptRunner import runScript
+from core.rx_queue import RxQueue, Packet
+from core.sleep_log import SleepLog
 from secrets import secrets
 
 FIFO = bytearray(256)
@@ -22,27 +25,36 @@ REMOTE_TOPIC =  secrets['remote'] + ID
 
 sendMSG = False # A flag to send a radio signal after initialization 
 
-def mqtt_message(client, topic, payload):
+async def mqtt_message(client, topic, payload):
+    # Runs on the MQTT reader task, so commands are handled while the radios
+    # keep receiving
     print("[{}] {}".format(topic, payload))
     try:
         if payload[:7] == 'PUBLISH':
             argsList = payload[8:].split(' ', 1) # Cuts off space as well
             topic = argsList[0]
             message = argsList[1]
-            client.publish(topic, message)
+            await client.publish(topic, message)
         elif payload[:4] == 'EXEC':
             exec(payload[5:])
         elif payload[:3] == 'RUN': # Just file name, no file type extension
             program = payload[4:]
             runScript(program)
         elif payload[:4] == 'SEND': 
-            GS.send_message(payload[5:], client)
+            await client.publish(REMOTE_TOPIC, GS.send_message(payload[5:]))
+        elif payload[:3] == 'TLE':
+            if GS.predictor is None:
+                raise ValueError("no LOCATION in gs_config, can't predict passes")
+            GS.predictor.set_tle(payload[4:])
+            await client.publish(REMOTE_TOPIC, "TLE saved. " + GS.describe_passes())
+        elif payload[:6] == 'PASSES':
+            await client.publish(REMOTE_TOPIC, GS.describe_passes())
         elif payload[:4] == 'PING':
             message = "You pinged ground station {0}. This is the local time: {1}".format(config['ID'], time.time())
-            client.publish(REMOTE_TOPIC, message)
+            await client.publish(REMOTE_TOPIC, message)
     except Exception as err:
         print('error: {}'.format(err))
-        client.publish(REMOTE_TOPIC, err)
+        await client.publish(REMOTE_TOPIC, str(err))
 
 def subscribe(mqtt_client, userdata, topic, granted_qos):
     # This method is called when the mqtt_client subscribes to a new feed.
@@ -57,6 +69,7 @@ def connected(client, userdata, flags, rc):
 class GroundStation:
     myuid = int.from_bytes(cpu.uid, 'big')
     last_rssi = 0
+    last_crc_ok = True
 
     SATELLITE = {
         # 436.703
@@ -77,11 +90,41 @@ class GroundStation:
         self.R1_CS.switch_to_output(True)
         self.R2_CS.switch_to_output(True)
         self.R3_CS.switch_to_output(True)
+        # DIO0 lines, also used as deep sleep wake alarms
+        self.IRQ_PINS = (board.IO5, board.IO6, board.IO7)
         self._BUFFER = bytearray(256)
 
         self.radios = None
         self.id = None
         self.mqtt_client = None
+        self.rx_queue = None
+        self._rx_tasks = None
+        # (start, end) time.time() of upcoming passes, for the scheduler,
+        # from predictor (core.passes.PassPredictor) if there is one
+        self.passes = []
+        self.predictor = None
+        # DiversityCombiner statistics since boot, radio -> [frames heard,
+        # times it had the best copy, CRC errors], sent with the status
+        self.rx_stats = {}
+        # sleep memory: counters and settings below, then frames cached
+        # while offline
+        self.sleep_log = SleepLog(alarm.sleep_memory, 24)
+
+    def update_passes(self):
+        if self.predictor is not None:
+            self.passes = [(aos, los) for aos, los, _ in self.predictor.passes(time.time())]
+        return self.passes
+
+    def describe_passes(self, count=3):
+        if self.predictor is None:
+            return "No pass predictions"
+        passes = self.predictor.passes(time.time())
+        if not passes:
+            return "No passes in the next day (TLE missing or clock not set?)"
+        now = time.time()
+        return "Next passes: " + ", ".join(
+            "in {}min for {}s max {}deg".format(int(aos - now) // 60, los - aos, el)
+            for aos, los, el in passes[:count])
 
     @property
     def battery_voltage(self):
@@ -105,11 +148,11 @@ class GroundStation:
 
         # initialize radios
         radio1 = pycubed_rfm9x.RFM9x(
-            board.SPI(), self.R1_CS, R1_RST, config['FREQ'])
+            board.SPI(), self.R1_CS, R1_RST, config['FREQ'], shadow_registers=True)
         radio2 = pycubed_rfm9x.RFM9x(
-            board.SPI(), self.R2_CS, R2_RST, config['FREQ'])
+            board.SPI(), self.R2_CS, R2_RST, config['FREQ'], shadow_registers=True)
         radio3 = pycubed_rfm9x.RFM9x(
-            board.SPI(), self.R3_CS, R3_RST, config['FREQ'])
+            board.SPI(), self.R3_CS, R3_RST, config['FREQ'], shadow_registers=True)
         radio1.name = 1
         radio2.name = 2
         radio3.name = 3
@@ -120,19 +163,20 @@ class GroundStation:
         for r in self.radios:
             r.node = 0xBA  # ground station ID
             r.destination = 0xAB # target sat's radiohead ID
-            r.idle()
 
-            # The two variables below need to be commented out if we want to test with our own radios
+            # The SF and BW values need to be left out if we want to test with our own radios
             # NOTE: Maybe this values are why we get crc errors. Moreover, when these weren't commented out for NORBI,
             # it didnt receive a signal. Until I commented them out and reloaded.
-            r.spreading_factor = config['SF']
-            r.signal_bandwidth = config['BW']
+            r.configure({
+                'SF': config['SF'],
+                'BW': config['BW'],
+                'CR': config['CR'],
+                'PREAMBLE': 8,
+                'CRC': False,
+                # NOTE: if getting crc error change this to false
+                'LDRO': False,
+            })
             r.baudrate = config['BR']  # added this
-            r.coding_rate = config['CR']
-            r.preamble_length = 8
-            r.enable_crc = False
-            # NOTE: if getting crc error change this to false
-            r.low_datarate_optimize = False
             r.ack_wait = 2
             r.ack_delay = 0.2
             r.ack_retries = 0
@@ -181,6 +225,54 @@ class GroundStation:
     def deep_sleep(self, value):
         alarm.sleep_memory[5:7] = int(value % 65536).to_bytes(2, 'big')
 
+    @property
+    def broker_address(self):
+        # resolved (ip, port) of the MQTT broker, so a wake can skip DNS
+        port = int.from_bytes(alarm.sleep_memory[11:13], 'big')
+        if not port:
+            return None
+        return ('.'.join(str(b) for b in alarm.sleep_memory[7:11]), port)
+
+    @broker_address.setter
+    def broker_address(self, value):
+        # only IPv4 fits, anything else is looked up every time
+        try:
+            ip = bytes(int(b) for b in value[0].split('.'))
+            port = int(value[1])
+        except (TypeError, ValueError, AttributeError):
+            ip, port = b'', 0
+        if len(ip) != 4:
+            ip, port = b'\x00\x00\x00\x00', 0
+        alarm.sleep_memory[7:11] = ip
+        alarm.sleep_memory[11:13] = port.to_bytes(2, 'big')
+
+    @property
+    def last_wake(self):
+        # time.time() the packet rate was last updated
+        return int.from_bytes(alarm.sleep_memory[13:17], 'big')
+
+    @last_wake.setter
+    def last_wake(self, value):
+        alarm.sleep_memory[13:17] = int(value % 4294967296).to_bytes(4, 'big')
+
+    @property
+    def rate_mark(self):
+        # msg_count when the packet rate was last updated
+        return int.from_bytes(alarm.sleep_memory[17:19], 'big')
+
+    @rate_mark.setter
+    def rate_mark(self, value):
+        alarm.sleep_memory[17:19] = int(value % 65536).to_bytes(2, 'big')
+
+    @property
+    def packet_rate(self):
+        # average frames per hour, kept in tenths
+        return int.from_bytes(alarm.sleep_memory[19:21], 'big') / 10
+
+    @packet_rate.setter
+    def packet_rate(self, value):
+        alarm.sleep_memory[19:21] = min(65535, int(value * 10)).to_bytes(2, 'big')
+
     def _read_into(self, radio_cs, address, buf, length=None):
         if length is None:
             length = len(buf)
@@ -230,21 +322,20 @@ class GroundStation:
             pass
         else:
             packet = None
-            error = 1
             self.set_to_idle(radio_cs)
             #if not (self._read_u8(radio_cs,0x12) & 0x20) >> 5:
-            if not self.is_crc(radio_cs): # same as above
-                l = self._read_u8(radio_cs, 0x13)  # fifo length
-                # print(l)
-                if l:
-                    pos = self._read_u8(radio_cs, 0x10)
-                    self._write_u8(radio_cs, 0x0D, pos)
-                    packet = fifo_view[:l]
-                    self._read_into(radio_cs, 0, packet)
-                error = 0
-            else:
+            # same as above, True when there is no CRC error. A corrupt copy
+            # is read out too, the other antennas may not have done better
+            self.last_crc_ok = self.is_crc(radio_cs)
+            if not self.last_crc_ok:
                 print('crc error')
-                yield b'CRC ERROR'
+            l = self._read_u8(radio_cs, 0x13)  # fifo length
+            # print(l)
+            if l:
+                pos = self._read_u8(radio_cs, 0x10)
+                self._write_u8(radio_cs, 0x0D, pos)
+                packet = fifo_view[:l]
+                self._read_into(radio_cs, 0, packet)
             # clear IRQ flags
             self.clear_irq(radio_cs)
             # start listening again TODO: Why do we want it to listen again? (Probably cause we want radios to listen again befoer shutdown (in this case before intitialization))
@@ -254,7 +345,7 @@ class GroundStation:
             self._write_u8(radio_cs, 0x01, reg)
             yield packet
                 
-    def send_message(self, message, client=None):
+    def send_message(self, message):
         # TODO: Change so it sends to all witih r.send paramter as we will have init id and dest nodes
         # Might not have to set them all to idle as it will send out with specific 
         log = ""
@@ -277,8 +368,7 @@ class GroundStation:
             else:
                 print("Radio {} failed to send message".format(r.name))
                 log += "Radio {} failed to send message".format(r.name)
-        if client != None:
-            client.publish(REMOTE_TOPIC, log)
+        return log
     
     def gs_listen(self):
         for r in self.radios:
@@ -320,7 +410,71 @@ class GroundStation:
                         print(f"Received message, but failed to verify as beacon {packet}")
         return None
 
-    def send_file(self, cmd, filename):
+    def start_rx(self, maxlen=16, timeout=5):
+        '''
+        Start one listener task per radio on the asyncio loop. Received frames
+        go into a shared bounded RxQueue (self.rx_queue). A listener that has
+        heard nothing for timeout seconds puts its radio back in RX in case
+        something transmitted on it. Must be called from a running event
+        loop, after init_radios.
+        '''
+        if self._rx_tasks:
+            return self.rx_queue
+        self.rx_queue = RxQueue(maxlen)
+        self._rx_tasks = []
+        for radio, pin in zip(self.radios, self.IRQ_PINS):
+            # Watch DIO0 directly so waiting for a packet costs no SPI traffic
+            radio.dio0 = digitalio.DigitalInOut(pin)
+            radio.dio0.switch_to_input()
+            self._rx_tasks.append(asyncio.create_task(self._rx_task(radio, timeout)))
+        return self.rx_queue
+
+    def stop_rx(self):
+        '''
+        Cancel the listener tasks and release the DIO0 pins so they can be
+        used as PinAlarms again. Radios are left listening.
+        '''
+        if not self._rx_tasks:
+            return
+        for task in self._rx_tasks:
+            task.cancel()
+        self._rx_tasks = None
+        for radio in self.radios:
+            if radio.dio0:
+                radio.dio0.deinit()
+                radio.dio0 = False
+            radio.listen()
+
+    def packets(self, maxlen=16):
+        '''
+        Received packets from all radios, oldest first:
+
+            async for pkt in GS.packets():
+                print(pkt.radio, pkt.rssi, pkt.data)
+        '''
+        return self.start_rx(maxlen)
+
+    async def _rx_task(self, radio, timeout):
+        # The radio stays in RX continuous, the FIFO is only read once DIO0
+        # says a packet is waiting. Frames are queued unfiltered, as
+        # get_msg2 does after a deep sleep, the address check is left to
+        # whoever decodes them.
+        radio.listen()
+        while True:
+            if not await radio.wait_rx_async(timeout):
+                # nothing heard: make sure a transmit in between didn't
+                # leave the radio in standby (free with shadow registers)
+                radio.listen()
+                continue
+            data, crc_ok = radio.read_fifo()
+            if data is not None:
+                self.rx_queue.put(Packet(radio.name, bytes(data), radio.last_rssi - 164,
+                                         radio.last_snr, time.time(), crc_ok))
+            # wait_rx_async returns without yielding if a packet was already
+            # waiting, so give the other radios a turn
+            await asyncio.sleep_ms(0)
+
+    async def send_file(self, cmd, filename):
         # TODO: This doesnt work 
         # Below would wait to receieve a beackon
         # Set them all to listen
@@ -330,15 +484,30 @@ class GroundStation:
         radio = self.gs_rx()
 
         if radio is None:
-            yield 'Error, no contact'
-        else:
-            ack = radio.send_with_ack(cmd)
-            if ack is not None:
-                if ack: print('ACK RSSI:',radio.last_rssi-137)
+            return 'Error, no contact'
+
+        local_path = f'/sd/{filename}'
+        saved = Transfer.load(local_path)
+        if saved is not None and saved.remote_path != filename:
+            # left over from another file, start this one from scratch
+            saved.remove()
+            saved = None
+        if saved is not None:
+            # started on an earlier pass, only ask for what is missing
+            if await radio.r_ftp.resume_file(local_path):
+                print("Received file!")
+            else:
+                print("File incomplete, resuming next pass")
+            return
 
-            num_packets, _ = await radio.r_aptp.receive_packet()
-            missing = await radio.radio_ftp.receive_file(f'/sd/{filename}', num_packets)
-            print(f"missing packets: {missing}")
+        ack = radio.send_with_ack(cmd)
+        if ack is not None:
+            if ack: print('ACK RSSI:',radio.last_rssi-137)
+
+        received = await radio.r_ftp.receive_file(local_path, transfer=Transfer(local_path, filename))
+        if received is not None and received.complete:
             print("Received file!")
+        else:
+            print(f"missing packets: {received.missing if received else 'all'}, resuming next pass")
 
 GS = GroundStation()
\ No newline at end of file
@@ -0,0 +1,61 @@
+import asyncio
+from collections import namedtuple
+
+# A received frame as handed out by GroundStation.packets()
+#   radio: radio name (1, 2, 3)
+#   data: raw frame, RadioHead header included
+#   rssi, snr: dBm and dB at reception
+#   time: time.time() at reception
+#   crc_ok: False if the payload CRC check failed
+Packet = namedtuple('Packet', ('radio', 'data', 'rssi', 'snr', 'time', 'crc_ok'))
+
+
+class RxQueue:
+    '''
+    Bounded FIFO shared by the per-radio listener tasks. When full the oldest
+    entry is dropped (and counted) so a busy radio can never block the others.
+    Iterate with `async for` to wait for packets.
+    '''
+
+    def __init__(self, maxlen=16, poll_ms=5):
+        self._items = [None] * maxlen
+        self._head = 0
+        self._len = 0
+        # The vendored asyncio.Event.wait() can return before set() is called,
+        # so consumers poll instead
+        self.poll_ms = poll_ms
+        self.dropped = 0
+
+    def __len__(self):
+        return self._len
+
+    def put(self, item):
+        size = len(self._items)
+        if self._len == size:
+            self._items[self._head] = None
+            self._head = (self._head + 1) % size
+            self._len -= 1
+            self.dropped += 1
+        self._items[(self._head + self._len) % size] = item
+        self._len += 1
+
+    def get_nowait(self):
+        '''Pop the oldest packet, or None if the queue is empty'''
+        if not self._len:
+            return None
+        item = self._items[self._head]
+        self._items[self._head] = None
+        self._head = (self._head + 1) % len(self._items)
+        self._len -= 1
+        return item
+
+    async def get(self):
+        while not self._len:
+            await asyncio.sleep_ms(self.poll_ms)
+        return self.get_nowait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
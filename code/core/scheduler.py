@@ -0,0 +1,67 @@
+# What to do until the next wake
+DEEP = 'deep'      # exit_and_deep_sleep_until_alarms, reboot on wake
+LIGHT = 'light'    # light_sleep_until_alarms, radios and WiFi stay set up
+LISTEN = 'listen'  # stay awake forwarding frames as they arrive
+
+
+class PowerScheduler:
+    '''
+    Picks how to sleep after each wake from the battery voltage, the recent
+    packet rate and upcoming passes.
+
+    - battery critical: deep sleep, long timer. The radios still wake us
+      on a packet, this just stops the timer wakes from draining it.
+    - during a pass (from `margin` seconds before it): listen until it ends
+    - packets coming in often: light sleep, a wake is then just the radio
+      read and the MQTT publish, no reboot or WiFi connect
+    - otherwise deep sleep, for longer on a low battery
+
+    The timer is cut short to wake up `margin` seconds before the next
+    pass. The packet rate is only updated over at least `window` seconds.
+    Voltages in V, rates in frames per hour, times in seconds (time.time()
+    for passes).
+    '''
+
+    def __init__(self, interval=600, low=3.6, critical=3.4, busy=6, margin=60, window=600):
+        self.interval = interval
+        self.low = low
+        self.critical = critical
+        self.busy = busy
+        self.margin = margin
+        self.window = window
+
+    def rate(self, previous, frames, seconds, weight=0.3):
+        '''
+        New frames/hour average after hearing frames in seconds, or None if
+        seconds is shorter than the window: one frame just after a wake
+        would read as hundreds an hour. Keep counting and ask again later.
+        '''
+        if seconds < self.window:
+            return None
+        return (1 - weight) * previous + weight * frames * 3600 / seconds
+
+    def plan(self, now, vbatt, rate, passes=()):
+        '''Returns (mode, seconds until the next wake)'''
+        upcoming = None
+        for start, end in passes:
+            if end - now < 1:
+                continue
+            if start - self.margin <= now:
+                if vbatt >= self.low:
+                    return LISTEN, int(end - now)
+                # not enough battery to stay up, stay reachable instead
+                return DEEP, max(1, int(min(end - now, self.interval)))
+            if upcoming is None or start < upcoming:
+                upcoming = start
+
+        if vbatt < self.critical:
+            mode, seconds = DEEP, 6 * self.interval
+        elif vbatt < self.low:
+            mode, seconds = DEEP, 3 * self.interval
+        elif rate >= self.busy:
+            mode, seconds = LIGHT, self.interval
+        else:
+            mode, seconds = DEEP, self.interval
+        if upcoming is not None and vbatt >= self.critical:
+            seconds = min(seconds, upcoming - self.margin - now)
+        return mode, max(1, int(seconds))
@@ -0,0 +1,130 @@
+from core.diversity import Frame
+
+# Record header: payload length, radios, RSSI (signed dBm), time (4 bytes).
+# The radios byte has the radio with the best copy in the low nibble and a
+# bit per radio that heard the frame in the high nibble. A length of 0 marks
+# the end of the used space before the ring wraps.
+_HEADER = 7
+# head, tail and record count, 2 bytes each, in front of the records
+_INDEX = 6
+
+
+class SleepLog:
+    '''
+    Ring buffer of received frames in alarm.sleep_memory, for caching frames
+    across deep sleep without touching the filesystem.
+
+    Records never straddle the end of the buffer: one that doesn't fit in
+    the space left there goes to the start. `append()` returns False when
+    there is no room, the caller moves the contents somewhere bigger (the
+    flash spool) and clears it. All zeros, as after a power cut, is an empty
+    log.
+    '''
+
+    def __init__(self, memory, start):
+        self._mem = memory
+        self._start = start + _INDEX
+        self._size = len(memory) - self._start
+        self._index = start
+        head, tail, count = self._read_index()
+        # head == size is a record that ended right at the end of the ring,
+        # the next one is at the start
+        if count and (head > self._size or tail > self._size):
+            self.clear()
+
+    def _read_index(self):
+        mem, i = self._mem, self._index
+        return (int.from_bytes(mem[i:i + 2], 'big'),
+                int.from_bytes(mem[i + 2:i + 4], 'big'),
+                int.from_bytes(mem[i + 4:i + 6], 'big'))
+
+    def _write_index(self, head, tail, count):
+        i = self._index
+        self._mem[i:i + 6] = (head.to_bytes(2, 'big') + tail.to_bytes(2, 'big')
+                              + count.to_bytes(2, 'big'))
+
+    def __len__(self):
+        return self._read_index()[2]
+
+    def clear(self):
+        self._write_index(0, 0, 0)
+
+    def append(self, frame):
+        '''Store a Frame. Returns False, storing nothing, if the log is full.'''
+        data = frame.data
+        n = _HEADER + len(data)
+        if not 0 < len(data) < 256 or n > self._size:
+            return False
+        head, tail, count = self._read_index()
+        if not count:
+            head = tail = 0
+        if tail >= head or not count:
+            if tail + n > self._size:
+                # wrap, leaving a marker if there is room for one. tail
+                # never catches up with head, head == tail means empty
+                if n >= head or not count:
+                    return False
+                if tail < self._size:
+                    self._mem[self._start + tail] = 0
+                tail = 0
+        elif tail + n >= head:
+            return False
+
+        radios = 0
+        for r in frame.radios:
+            radios |= 1 << (r + 3)
+        rssi = max(-128, min(127, int(frame.rssi)))
+        i = self._start + tail
+        mem = self._mem
+        mem[i] = len(data)
+        mem[i + 1] = radios | (frame.radio & 0x0F)
+        mem[i + 2] = rssi & 0xFF
+        mem[i + 3:i + 7] = (int(frame.time) & 0xFFFFFFFF).to_bytes(4, 'big')
+        mem[i + 7:i + n] = data
+        self._write_index(head, tail + n, count + 1)
+        return True
+
+    def _record(self, p):
+        '''Offset of the record at or wrapped around from p, and its length'''
+        if p >= self._size or not self._mem[self._start + p]:
+            p = 0
+        length = self._mem[self._start + p]
+        if not length or p + _HEADER + length > self._size:
+            # not what append() wrote
+            return p, None
+        return p, length
+
+    def drop(self, count):
+        '''Forget the oldest count frames, once they have been delivered.'''
+        head, tail, stored = self._read_index()
+        count = min(count, stored)
+        for _ in range(count):
+            head, length = self._record(head)
+            if length is None:
+                self.clear()
+                return
+            head += _HEADER + length
+        if head >= self._size:
+            head = 0
+        if count == stored:
+            self.clear()
+        else:
+            self._write_index(head, tail, stored - count)
+
+    def frames(self):
+        '''The stored frames, oldest first. The log is left as it is.'''
+        head, tail, count = self._read_index()
+        mem = self._mem
+        frames = []
+        p = head
+        while len(frames) < count:
+            p, length = self._record(p)
+            if length is None:
+                break
+            i = self._start + p
+            radios = [r for r in (1, 2, 3) if mem[i + 1] & (1 << (r + 3))]
+            rssi = mem[i + 2] - 256 if mem[i + 2] > 127 else mem[i + 2]
+            frames.append(Frame(bytes(mem[i + 7:i + 7 + length]), mem[i + 1] & 0x0F, rssi,
+                                radios, True, int.from_bytes(mem[i + 3:i + 7], 'big')))
+            p += _HEADER + length
+        return frames
@@ -0,0 +1,129 @@
+import os
+import storage
+from binascii import crc32
+
+# Record header: magic, payload length (2 bytes), CRC32 of the payload (4 bytes)
+_MAGIC = 0xA5
+_HEADER = 7
+# The file starts with the read cursor, the offset of the first unsent record
+_CURSOR = 4
+_MAX_RECORD = 0xFFFF
+
+
+class Spool:
+    '''
+    Append-only store for messages that couldn't be sent, kept on CIRCUITPY.
+
+    The file is the 4 byte read cursor followed by length prefixed records,
+    each with a CRC so a record torn by a power cut (or flash corruption) is
+    skipped instead of sent. Writers append a whole batch with one remount
+    and one write. Readers take records from the cursor with `read()` and
+    only move it with `commit()` once the broker has them, so a drain cut
+    short resends from where the last acknowledged batch ended.
+    '''
+
+    def __init__(self, path='/spool.bin'):
+        self.path = path
+        # records skipped because their header or CRC didn't check out
+        self.dropped = 0
+
+    def _size(self):
+        try:
+            return os.stat(self.path)[6]
+        except OSError:
+            return 0
+
+    def __bool__(self):
+        return self._size() > self.cursor
+
+    @property
+    def cursor(self):
+        try:
+            with open(self.path, 'rb') as f:
+                cursor = int.from_bytes(f.read(_CURSOR), 'big')
+        except OSError:
+            return _CURSOR
+        return max(cursor, _CURSOR)
+
+    def append(self, records):
+        '''
+        Add payloads (bytes) to the end of the spool. Raises if CIRCUITPY
+        can't be remounted writable (e.g. mounted over USB).
+        '''
+        size = 0
+        for record in records:
+            if len(record) > _MAX_RECORD:
+                raise ValueError('record too long')
+            size += _HEADER + len(record)
+        if not size:
+            return
+        buf = bytearray(size)
+        i = 0
+        for record in records:
+            buf[i] = _MAGIC
+            buf[i + 1:i + 3] = len(record).to_bytes(2, 'big')
+            buf[i + 3:i + 7] = crc32(record).to_bytes(4, 'big')
+            buf[i + 7:i + 7 + len(record)] = record
+            i += _HEADER + len(record)
+
+        new = not self._size()
+        storage.remount('/', False)
+        try:
+            with open(self.path, 'ab') as f:
+                if new:
+                    f.write(_CURSOR.to_bytes(_CURSOR, 'big'))
+                f.write(buf)
+        finally:
+            storage.remount('/', True)
+
+    def read(self, offset, count):
+        '''
+        Up to count payloads starting at offset. Returns (payloads, offset
+        after the last one); pass that offset to the next read and, once
+        the payloads are delivered, to commit().
+        '''
+        payloads = []
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            return payloads, offset
+        with f:
+            f.seek(offset)
+            header = bytearray(_HEADER)
+            skipping = False
+            while len(payloads) < count:
+                if f.readinto(header) != _HEADER:
+                    break
+                length = int.from_bytes(header[1:3], 'big')
+                record = f.read(length) if header[0] == _MAGIC else b''
+                if header[0] != _MAGIC or len(record) != length \
+                        or crc32(record) != int.from_bytes(header[3:7], 'big'):
+                    # look for the next record one byte further on
+                    if not skipping:
+                        self.dropped += 1
+                    skipping = True
+                    offset += 1
+                    f.seek(offset)
+                    continue
+                skipping = False
+                payloads.append(record)
+                offset += _HEADER + length
+        return payloads, offset
+
+    def commit(self, offset):
+        '''
+        Mark everything before offset as delivered. The file is removed once
+        it has all been sent.
+        '''
+        if offset <= self.cursor:
+            return
+        storage.remount('/', False)
+        try:
+            # what is left can't be a whole record
+            if offset + _HEADER > self._size():
+                os.remove(self.path)
+            else:
+                with open(self.path, 'r+b') as f:
+                    f.write(offset.to_bytes(_CURSOR, 'big'))
+        finally:
+            storage.remount('/', True)
@@ -1,4 +1,13 @@
 config = {
     'ID': 'A',
-    'SAT': 'RADIO'
+    'SAT': 'RADIO',
+    # lat, lon (degrees), altitude (m), for pass prediction
+    'LOCATION': (37.4275, -122.1697, 30),
+    # retune the radios for the Doppler shift while listening to a pass
+    'DOPPLER': True,
+    # 'auto': core/scheduler.py picks deep sleep, light sleep or listening
+    #         from the battery, the packet rate and upcoming passes
+    # 'sleep': always deep sleep for 600s between wakes
+    # 'listen': stay up and forward frames as they arrive, mains power only
+    'MODE': 'auto'
 }
\ No newline at end of file
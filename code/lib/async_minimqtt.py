@@ -0,0 +1,666 @@
+"""
+`async_minimqtt`
+================================================================================
+
+asyncio MQTT 3.1.1 client for CircuitPython socketpool sockets.
+
+The socket is non-blocking and every wait is an `asyncio.sleep_ms` poll, so
+the radio tasks keep running while we talk to the broker. A reader task
+dispatches incoming packets (commands go to `on_message`, acks wake the
+coroutine waiting on them) and a timer task pings the broker when the link
+has been idle for half the keepalive interval.
+
+`publish` takes str or bytes-like payloads, `publish_into` sends a payload
+from a caller-owned buffer with room for the header in front of it and
+`publish_many` packs a batch of messages into as few writes as it can.
+
+QoS 1 and 2 publishes are pipelined: `publish` returns as soon as the
+packet is written and up to `max_inflight` of them can wait for their acks
+at once. Unacknowledged ones are resent with the DUP flag every
+`retry_timeout` seconds, `flush()` waits for all of them. `on_publish` is
+called when the broker has the message (PUBACK, or PUBCOMP for QoS 2).
+
+Callbacks have the MiniMQTT signatures. `on_message` may be a coroutine
+function, the reader awaits it.
+
+    mqtt = MQTT(broker, 1883, socket_pool=pool)
+    mqtt.on_message = handler
+    await mqtt.connect()
+    await mqtt.subscribe('cmd/A')
+    await mqtt.publish('data', 'hello', qos=1)
+    await mqtt.flush()
+    await mqtt.disconnect()
+
+The vendored asyncio streams can't be used here: `open_connection` needs
+`usocket` and `select.poll` support that socketpool sockets don't have.
+"""
+import errno
+import struct
+import time
+from random import randint
+
+import asyncio
+import microcontroller
+from micropython import const
+
+MQTT_TCP_PORT = const(1883)
+MQTT_TOPIC_LENGTH_LIMIT = const(65535)
+MQTT_MSG_MAX_SZ = const(268435455)
+
+# Packet types (first byte, flags cleared)
+CONNECT = const(0x10)
+CONNACK = const(0x20)
+PUBLISH = const(0x30)
+PUBACK = const(0x40)
+PUBREC = const(0x50)
+PUBREL = const(0x60)
+PUBCOMP = const(0x70)
+SUBSCRIBE = const(0x80)
+SUBACK = const(0x90)
+UNSUBSCRIBE = const(0xA0)
+UNSUBACK = const(0xB0)
+PINGREQ = const(0xC0)
+PINGRESP = const(0xD0)
+DISCONNECT = const(0xE0)
+
+_DUP = const(0x08)
+_PINGREQ = b'\xc0\x00'
+_DISCONNECT = b'\xe0\x00'
+
+CONNACK_ERRORS = {
+    const(0x01): 'Connection Refused - Incorrect Protocol Version',
+    const(0x02): 'Connection Refused - ID Rejected',
+    const(0x03): 'Connection Refused - Server unavailable',
+    const(0x04): 'Connection Refused - Incorrect username/password',
+    const(0x05): 'Connection Refused - Unauthorized',
+}
+
+# Errors a non-blocking socket raises when it would block
+_WOULD_BLOCK = (errno.EAGAIN, errno.ETIMEDOUT)
+
+
+class MMQTTException(Exception):
+    """MiniMQTT Exception class."""
+
+
+def _encode_length(buf, offset, length):
+    """Write an MQTT remaining length at buf[offset:], return the new offset."""
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        if length:
+            buf[offset] = byte | 0x80
+            offset += 1
+        else:
+            buf[offset] = byte
+            return offset + 1
+
+
+class MQTT:
+    """asyncio MQTT client
+    :param str broker: MQTT Broker URL or IP Address.
+    :param int port: Broker port, defaults to 1883.
+    :param socket_pool: socketpool.SocketPool to open the connection with.
+    :param str client_id: Optional client identifier, defaults to a unique, generated string.
+    :param str username: Username for broker authentication.
+    :param str password: Password for broker authentication.
+    :param int keep_alive: KeepAlive interval in seconds.
+    :param int recv_timeout: Seconds to wait for CONNACK/SUBACK before giving up.
+    :param int max_inflight: QoS 1/2 publishes that can wait for acks at once.
+    :param int retry_timeout: Seconds before an unacknowledged publish is resent.
+    :param int poll_ms: How often to poll the socket while waiting.
+    :param int tx_size: Publishes up to this size (header included) go out
+        in a single write from a preallocated buffer, bigger payloads are
+        written straight from the caller's object after the header.
+    """
+
+    def __init__(self, broker, port=MQTT_TCP_PORT, *, socket_pool, client_id=None,
+                 username=None, password=None, keep_alive=60, recv_timeout=10,
+                 max_inflight=8, retry_timeout=5, poll_ms=10, tx_size=512):
+        self.broker = broker
+        self.port = port
+        self._pool = socket_pool
+        self.user = username
+        self.password = password
+        if client_id is None:
+            # same scheme as MiniMQTT
+            client_id = 'cpy{0}{1}'.format(microcontroller.cpu.uid[randint(0, 15)], randint(0, 9))
+        if not 0 < len(client_id) <= 23:
+            raise ValueError('MQTT Client ID must be between 1 and 23 bytes')
+        self.client_id = client_id
+        self.address = None
+        self.keep_alive = keep_alive
+        self.recv_timeout = recv_timeout
+        self.max_inflight = max_inflight
+        self.retry_timeout = retry_timeout
+        self.poll_ms = poll_ms
+        self.user_data = None
+
+        self._sock = None
+        self._connected = False
+        self._pid = 0
+        # packet id -> ack body, filled in by the reader
+        self._acks = {}
+        # outgoing QoS 1/2: packet id -> [header, payload, time sent, ack expected, topic]
+        # header and payload are what gets resent
+        self._inflight = {}
+        # incoming QoS 2 packet ids delivered but not yet released
+        self._received = set()
+        self._sending = False
+        self._last_rx = 0
+        self._last_tx = 0
+        self._tasks = ()
+        self._header = bytearray(5)
+        # PUBLISH packets are put together here, str topic -> utf-8 cache
+        self._tx = bytearray(tx_size)
+        self._topics = {}
+
+        # Server callbacks
+        self.on_message = None
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+        self.on_subscribe = None
+
+    @property
+    def is_connected(self):
+        return self._connected
+
+    # -- socket ------------------------------------------------------------
+
+    async def _lock(self):
+        """Take the socket for writing. Packets are never interleaved: a
+        writer waits for the one in progress."""
+        while self._sending:
+            await asyncio.sleep_ms(self.poll_ms)
+        self._sending = True
+
+    def _unlock(self):
+        self._sending = False
+
+    async def _write(self, data):
+        """Write all of data, yielding while the socket is busy. Hold the
+        lock around it."""
+        view = memoryview(data)
+        sent = 0
+        while sent < len(view):
+            try:
+                n = self._sock.send(view[sent:])
+            except OSError as e:
+                if e.errno not in _WOULD_BLOCK:
+                    raise
+                n = 0
+            if n:
+                sent += n
+            else:
+                await asyncio.sleep_ms(self.poll_ms)
+        self._last_tx = time.monotonic()
+
+    async def _send(self, data, more=None):
+        """Write one packet, in two parts if more is given."""
+        await self._lock()
+        try:
+            await self._write(data)
+            if more is not None:
+                await self._write(more)
+        finally:
+            self._unlock()
+
+    async def _recv_into(self, buf, deadline=None):
+        """Fill buf from the socket, giving up with MMQTTException if the
+        deadline (time.monotonic()) passes first."""
+        view = memoryview(buf)
+        got = 0
+        while got < len(view):
+            try:
+                n = self._sock.recv_into(view[got:])
+            except OSError as e:
+                if e.errno not in _WOULD_BLOCK:
+                    raise
+                if deadline is not None and time.monotonic() > deadline:
+                    raise MMQTTException('Timed out waiting for the broker')
+                await asyncio.sleep_ms(self.poll_ms)
+                continue
+            if not n:
+                raise MMQTTException('Connection closed by broker')
+            got += n
+        self._last_rx = time.monotonic()
+
+    async def _read_packet(self, deadline=None):
+        """Return (first byte, body) of the next packet from the broker."""
+        byte = self._header
+        await self._recv_into(memoryview(byte)[:1], deadline)
+        kind = byte[0]
+        length = shift = 0
+        while True:
+            await self._recv_into(memoryview(byte)[1:2], deadline)
+            length |= (byte[1] & 0x7F) << shift
+            shift += 7
+            if not byte[1] & 0x80:
+                break
+        body = bytearray(length)
+        if length:
+            await self._recv_into(body, deadline)
+        return kind, body
+
+    def _next_pid(self):
+        while True:
+            self._pid = self._pid % 0xFFFF + 1
+            if self._pid not in self._inflight:
+                return self._pid
+
+    async def _wait_ack(self, pid):
+        """Wait for the reader to see the ack for pid, return its body."""
+        deadline = time.monotonic() + self.recv_timeout
+        while pid not in self._acks:
+            if not self._connected:
+                raise MMQTTException('Connection lost')
+            if time.monotonic() > deadline:
+                raise MMQTTException('No ack from broker for packet {}'.format(pid))
+            await asyncio.sleep_ms(self.poll_ms)
+        return self._acks.pop(pid)
+
+    # -- connection --------------------------------------------------------
+
+    async def connect(self, clean_session=True, address=None):
+        """Open the connection and wait for CONNACK. Starts the reader and
+        keepalive tasks. Returns the session present flag.
+        :param bool clean_session: False asks the broker to keep our
+            subscriptions and queued messages while we are away.
+        :param tuple address: (ip, port) to connect to instead of looking
+            up broker. The address used ends up in self.address.
+        """
+        if address is None:
+            address = self._pool.getaddrinfo(self.broker, self.port)[0][-1]
+        self._sock = self._pool.socket(self._pool.AF_INET, self._pool.SOCK_STREAM)
+        try:
+            self._sock.settimeout(self.recv_timeout)
+            self._sock.connect(address)
+        except OSError:
+            self._sock.close()
+            self._sock = None
+            raise
+        self._sock.settimeout(0)
+        self.address = address
+
+        flags = clean_session << 1
+        remaining = 10 + 2 + len(self.client_id)
+        if self.user is not None:
+            flags |= 0xC0
+            remaining += 2 + len(self.user) + 2 + len(self.password)
+        packet = bytearray(5 + remaining)
+        packet[0] = CONNECT
+        i = _encode_length(packet, 1, remaining)
+        packet[i:i + 10] = b'\x00\x04MQTT\x04' + bytes((flags,)) + struct.pack('!H', self.keep_alive)
+        i += 10
+        fields = [self.client_id]
+        if self.user is not None:
+            fields += [self.user, self.password]
+        for field in fields:
+            field = field.encode('utf-8') if isinstance(field, str) else field
+            struct.pack_into('!H', packet, i, len(field))
+            packet[i + 2:i + 2 + len(field)] = field
+            i += 2 + len(field)
+        try:
+            await self._send(memoryview(packet)[:i])
+            kind, body = await self._read_packet(time.monotonic() + self.recv_timeout)
+            if kind != CONNACK:
+                raise MMQTTException('Expected CONNACK, got {:#x}'.format(kind))
+            if body[1] != 0:
+                raise MMQTTException(CONNACK_ERRORS.get(body[1], 'Connection Refused'))
+        except (OSError, MMQTTException):
+            self._close()
+            raise
+        self._connected = True
+        self._acks = {}
+        self._tasks = (asyncio.create_task(self._reader()), asyncio.create_task(self._timer()))
+        if self.on_connect is not None:
+            self.on_connect(self, self.user_data, body[0] & 1, body[1])
+        return body[0] & 1
+
+    async def disconnect(self):
+        """Send DISCONNECT and close the socket."""
+        if self._connected:
+            try:
+                await self._send(_DISCONNECT)
+            except OSError:
+                pass
+        self._close()
+
+    def _close(self):
+        was_connected = self._connected
+        self._connected = False
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self._tasks = ()
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if was_connected and self.on_disconnect is not None:
+            self.on_disconnect(self, self.user_data, 0)
+
+    async def ping(self):
+        """Send a PINGREQ, the reader notes the PINGRESP."""
+        await self._send(_PINGREQ)
+
+    # -- messages ----------------------------------------------------------
+
+    def _encode_topic(self, topic):
+        encoded = self._topics.get(topic)
+        if encoded is None:
+            if '+' in topic or '#' in topic:
+                raise MMQTTException('Publish topic can not contain wildcards.')
+            encoded = topic.encode('utf-8')
+            if len(encoded) > MQTT_TOPIC_LENGTH_LIMIT:
+                raise MMQTTException('Topic length is too large.')
+            if len(self._topics) < 16:
+                self._topics[topic] = encoded
+        return encoded
+
+    def _publish_header(self, buf, offset, encoded, length, retain, qos, pid):
+        """Write a PUBLISH header for a length byte payload at buf[offset:],
+        return where the payload goes."""
+        remaining = 2 + len(encoded) + length + (2 if qos else 0)
+        if remaining > MQTT_MSG_MAX_SZ:
+            raise MMQTTException('Message size larger than {}b.'.format(MQTT_MSG_MAX_SZ))
+        buf[offset] = PUBLISH | qos << 1 | retain
+        i = _encode_length(buf, offset + 1, remaining)
+        struct.pack_into('!H', buf, i, len(encoded))
+        buf[i + 2:i + 2 + len(encoded)] = encoded
+        i += 2 + len(encoded)
+        if qos:
+            struct.pack_into('!H', buf, i, pid)
+            i += 2
+        return i
+
+    async def _reserve(self, qos):
+        """Packet id for a publish, once the in-flight window has room."""
+        if not self._connected:
+            raise MMQTTException('MiniMQTT is not connected.')
+        if qos not in (0, 1, 2):
+            raise MMQTTException('QoS must be 0, 1 or 2.')
+        if not qos:
+            return 0
+        while len(self._inflight) >= self.max_inflight:
+            if not self._connected:
+                raise MMQTTException('Connection lost')
+            await asyncio.sleep_ms(self.poll_ms)
+        return self._next_pid()
+
+    def _track(self, pid, qos, header, payload, topic):
+        if qos:
+            self._inflight[pid] = [header, payload, time.monotonic(), PUBACK if qos == 1 else PUBREC, topic]
+        elif self.on_publish is not None:
+            self.on_publish(self, self.user_data, topic, 0)
+
+    def headroom(self, topic, qos=0):
+        """Bytes publish_into() needs in front of the payload for topic."""
+        return 5 + 2 + len(self._encode_topic(topic)) + (2 if qos else 0)
+
+    def _payload(self, msg):
+        if isinstance(msg, (int, float)):
+            return str(msg).encode('ascii')
+        if isinstance(msg, str):
+            return msg.encode('utf-8')
+        if not isinstance(msg, (bytes, bytearray, memoryview)):
+            raise MMQTTException('Invalid message data type.')
+        return msg
+
+    async def publish(self, topic, msg, retain=False, qos=0):
+        """Publishes a message to a topic. Returns the packet id (0 for qos 0)
+        once the packet is written, waiting first for a free slot in the
+        in-flight window if qos > 0.
+        :param str topic: Unique topic identifier.
+        :param msg: str, int or float to send, or bytes, bytearray or
+            memoryview to send as is. For qos > 0 a copy of a mutable
+            payload is kept for retransmission.
+        :param bool retain: Whether the message is saved by the broker.
+        :param int qos: Quality of Service level, 0, 1 or 2.
+        """
+        msg = self._payload(msg)
+        encoded = self._encode_topic(topic)
+        pid = await self._reserve(qos)
+        await self._lock()
+        try:
+            tx = self._tx
+            n = self._publish_header(tx, 0, encoded, len(msg), retain, qos, pid)
+            if qos:
+                self._track(pid, qos, tx[:n], msg if isinstance(msg, bytes) else bytes(msg), topic)
+            if n + len(msg) <= len(tx):
+                # one write per packet: small writes stall on Nagle + delayed ACK
+                tx[n:n + len(msg)] = msg
+                await self._write(memoryview(tx)[:n + len(msg)])
+            else:
+                await self._write(memoryview(tx)[:n])
+                await self._write(msg)
+        finally:
+            self._unlock()
+        if not qos:
+            self._track(pid, qos, None, None, topic)
+        return pid
+
+    async def publish_many(self, messages, retain=False, qos=0):
+        """Publish (topic, msg) pairs with as few socket writes as possible.
+        Packets are packed back to back in the tx buffer, which is written
+        out whenever the next one doesn't fit (or, for qos > 0, when the
+        in-flight window is full and we have to wait for acks). Returns the
+        packet ids.
+        """
+        if not self._connected:
+            raise MMQTTException('MiniMQTT is not connected.')
+        if qos not in (0, 1, 2):
+            raise MMQTTException('QoS must be 0, 1 or 2.')
+        pids = []
+        sent = []
+        tx = self._tx
+        used = 0
+        await self._lock()
+        try:
+            for topic, msg in messages:
+                msg = self._payload(msg)
+                encoded = self._encode_topic(topic)
+                pid = 0
+                if qos:
+                    if len(self._inflight) >= self.max_inflight:
+                        # let the reader in to process acks while we wait
+                        await self._write(memoryview(tx)[:used])
+                        used = 0
+                        self._unlock()
+                        try:
+                            pid = await self._reserve(qos)
+                        finally:
+                            await self._lock()
+                    else:
+                        pid = self._next_pid()
+                if used + 9 + len(encoded) + len(msg) > len(tx) and used:
+                    await self._write(memoryview(tx)[:used])
+                    used = 0
+                n = self._publish_header(tx, used, encoded, len(msg), retain, qos, pid)
+                if qos:
+                    self._track(pid, qos, tx[used:n], msg if isinstance(msg, bytes) else bytes(msg), topic)
+                if n + len(msg) <= len(tx):
+                    tx[n:n + len(msg)] = msg
+                    used = n + len(msg)
+                else:
+                    # too big to pack, header then payload straight from msg
+                    await self._write(memoryview(tx)[:n])
+                    await self._write(msg)
+                    used = 0
+                pids.append(pid)
+                if not qos:
+                    sent.append(topic)
+            if used:
+                await self._write(memoryview(tx)[:used])
+        finally:
+            self._unlock()
+        for topic in sent:
+            self._track(0, 0, None, None, topic)
+        return pids
+
+    async def publish_into(self, topic, buf, start, end=None, retain=False, qos=0):
+        """Publish buf[start:end] in a single write without copying it. The
+        PUBLISH header is written into buf just before start, which needs
+        headroom(topic, qos) bytes free. For qos > 0 a copy is kept for
+        retransmission, so buf can be reused as soon as this returns.
+
+            start = mqtt.headroom(topic)
+            buf = bytearray(start + 256)
+            n = fill(memoryview(buf)[start:])  # e.g. a radio FIFO read
+            await mqtt.publish_into(topic, buf, start, start + n)
+        """
+        end = len(buf) if end is None else end
+        encoded = self._encode_topic(topic)
+        length = end - start
+        remaining = 2 + len(encoded) + length + (2 if qos else 0)
+        size = 1 + 1 + (remaining > 0x7F) + (remaining > 0x3FFF) + (remaining > 0x1FFFFF) \
+            + remaining - length
+        if size > start:
+            raise MMQTTException('publish_into needs {} bytes before the payload'.format(size))
+        pid = await self._reserve(qos)
+        view = memoryview(buf)
+        self._publish_header(buf, start - size, encoded, length, retain, qos, pid)
+        if qos:
+            self._track(pid, qos, bytearray(view[start - size:start]), bytes(view[start:end]), topic)
+        await self._send(view[start - size:end])
+        if not qos:
+            self._track(pid, qos, None, None, topic)
+        return pid
+
+    async def flush(self, timeout=None):
+        """Wait until the broker has acknowledged every QoS 1/2 publish.
+        :param timeout: Seconds to wait at most, None for as long as the
+            connection lasts.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._inflight:
+            if not self._connected:
+                raise MMQTTException('Connection lost, {} messages not acknowledged'.format(
+                    len(self._inflight)))
+            if deadline is not None and time.monotonic() > deadline:
+                raise MMQTTException('{} messages not acknowledged'.format(len(self._inflight)))
+            await asyncio.sleep_ms(self.poll_ms)
+
+    def _acked(self, pid, kind):
+        entry = self._inflight.get(pid)
+        if entry is None or entry[3] != kind:
+            return
+        del self._inflight[pid]
+        if self.on_publish is not None:
+            self.on_publish(self, self.user_data, entry[4], pid)
+
+    async def subscribe(self, topic, qos=0):
+        """Subscribes to a topic and waits for the SUBACK.
+        :param str topic: Unique MQTT topic identifier.
+        :param int qos: Quality of Service level for the topic.
+        """
+        if not self._connected:
+            raise MMQTTException('MiniMQTT is not connected.')
+        encoded = topic.encode('utf-8')
+        pid = self._next_pid()
+        remaining = 2 + 2 + len(encoded) + 1
+        packet = bytearray(5 + remaining)
+        packet[0] = SUBSCRIBE | 0x02
+        i = _encode_length(packet, 1, remaining)
+        struct.pack_into('!HH', packet, i, pid, len(encoded))
+        i += 4
+        packet[i:i + len(encoded)] = encoded
+        packet[i + len(encoded)] = qos
+        await self._send(memoryview(packet)[:i + len(encoded) + 1])
+        try:
+            granted = (await self._wait_ack(pid))[2]
+        except MMQTTException:
+            # no SUBACK in recv_timeout, don't trust the connection
+            self._close()
+            raise
+        if granted == 0x80:
+            raise MMQTTException('SUBACK Failure!')
+        if self.on_subscribe is not None:
+            self.on_subscribe(self, self.user_data, topic, granted)
+
+    # -- background tasks --------------------------------------------------
+
+    async def _reader(self):
+        try:
+            while self._connected:
+                kind, body = await self._read_packet()
+                await self._dispatch(kind, body)
+        except (OSError, MMQTTException) as e:
+            print('MQTT connection lost: {}'.format(e))
+            self._close()
+
+    async def _dispatch(self, kind, body):
+        packet = kind & 0xF0
+        if packet == PUBLISH:
+            qos = (kind >> 1) & 0x03
+            topic_len = struct.unpack_from('!H', body)[0]
+            i = 2 + topic_len
+            if qos == 1:
+                pid = struct.unpack_from('!H', body, i)[0]
+                i += 2
+                await self._send(struct.pack('!BBH', PUBACK, 2, pid))
+            elif qos == 2:
+                pid = struct.unpack_from('!H', body, i)[0]
+                i += 2
+                await self._send(struct.pack('!BBH', PUBREC, 2, pid))
+                if pid in self._received:
+                    # resent before our PUBREC got through, already delivered
+                    return
+                self._received.add(pid)
+            if self.on_message is not None:
+                # acked above either way, so a message that isn't valid
+                # UTF-8 is dropped instead of killing the reader
+                try:
+                    topic = str(body[2:2 + topic_len], 'utf-8')
+                    msg = str(body[i:], 'utf-8')
+                except UnicodeError:
+                    print('MQTT dropped a message that is not UTF-8')
+                    return
+                result = self.on_message(self, topic, msg)
+                if hasattr(result, 'send'):
+                    await result
+        elif packet == PUBACK or packet == PUBCOMP:
+            self._acked(struct.unpack_from('!H', body)[0], packet)
+        elif packet == PUBREC:
+            pid = struct.unpack_from('!H', body)[0]
+            release = struct.pack('!BBH', PUBREL | 0x02, 2, pid)
+            entry = self._inflight.get(pid)
+            if entry is not None and entry[3] == PUBREC:
+                # the broker has the message, from now on resend PUBREL
+                entry[0] = release
+                entry[1] = None
+                entry[2] = time.monotonic()
+                entry[3] = PUBCOMP
+            await self._send(release)
+        elif packet == PUBREL:
+            pid = struct.unpack_from('!H', body)[0]
+            self._received.discard(pid)
+            await self._send(struct.pack('!BBH', PUBCOMP, 2, pid))
+        elif packet in (SUBACK, UNSUBACK):
+            self._acks[struct.unpack_from('!H', body)[0]] = body
+        # PINGRESP only needs to refresh _last_rx, which _read_packet did
+
+    async def _timer(self):
+        while self._connected:
+            await asyncio.sleep_ms(1000)
+            now = time.monotonic()
+            if self._inflight:
+                await self._retransmit(now)
+            if not self.keep_alive:
+                continue
+            if now - self._last_rx > 1.5 * self.keep_alive:
+                print('MQTT broker stopped answering')
+                self._close()
+                return
+            if now - self._last_tx >= self.keep_alive / 2:
+                await self.ping()
+
+    async def _retransmit(self, now):
+        for pid, entry in list(self._inflight.items()):
+            if now - entry[2] < self.retry_timeout or self._inflight.get(pid) is not entry:
+                continue
+            header = entry[0]
+            if header[0] & 0xF0 == PUBLISH:
+                header[0] |= _DUP
+            entry[2] = now
+            await self._send(header, entry[1])
@@ -13,119 +13,542 @@ Implementation Notes
 """
 import os
 import math
+import time
+from binascii import crc32
+
+
+class ChunkBitmap:
+    """Which of `size` chunks have arrived, one bit each. A 1 MB file in
+    245 byte chunks takes 535 bytes, where a set of the missing indices
+    would take tens of KB.
+
+    On the wire the missing chunks go as runs, a flat
+    [start, count, start, count, ...] list, which keeps a request for the
+    gaps in a single radio frame.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        self.count = 0
+        # every chunk below this has arrived
+        self._first = 0
+
+    def __contains__(self, i):
+        return 0 <= i < self.size and bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    def add(self, i):
+        """Mark chunk i as received. False if it already was, or isn't one
+        of ours."""
+        if not 0 <= i < self.size or self.bits[i >> 3] & (1 << (i & 7)):
+            return False
+        self.bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+        return True
+
+    def add_ranges(self, ranges):
+        """Mark the runs in a flat [start, count, ...] list as received"""
+        for n in range(0, len(ranges) - 1, 2):
+            for i in range(ranges[n], ranges[n] + ranges[n + 1]):
+                self.add(i)
+
+    @property
+    def missing(self):
+        return self.size - self.count
+
+    @property
+    def complete(self):
+        return self.count >= self.size
+
+    def _skip(self, i, end, received):
+        # first chunk from i on (up to end) that is not in the given state,
+        # a byte at a time where the whole byte matches
+        full = 0xFF if received else 0
+        bits = self.bits
+        while i < end:
+            if not i & 7 and i + 8 <= end and bits[i >> 3] == full:
+                i += 8
+            elif bool(bits[i >> 3] & (1 << (i & 7))) == received:
+                i += 1
+            else:
+                break
+        return min(i, end)
+
+    def write(self, f):
+        f.write(self.size.to_bytes(4, 'big'))
+        f.write(self.bits)
+
+    @classmethod
+    def read(cls, f):
+        """A bitmap written by write(), None if there isn't a whole one.
+        Bits only ever get set, so a write cut short by a power cut still
+        only marks chunks that had arrived."""
+        size = int.from_bytes(f.read(4), 'big')
+        bits = f.read()
+        if not size or len(bits) != (size + 7) // 8:
+            return None
+        bitmap = cls(size)
+        bitmap.bits[:] = bits
+        for byte in bits:
+            while byte:
+                byte &= byte - 1
+                bitmap.count += 1
+        return bitmap
+
+    def first_missing(self):
+        self._first = self._skip(self._first, self.size, True)
+        return self._first
+
+    def missing_ranges(self, end=None, limit=None):
+        """Runs of missing chunks below end (all of them by default), at
+        most limit runs"""
+        end = self.size if end is None else min(end, self.size)
+        ranges = []
+        i = self.first_missing()
+        while i < end and (limit is None or len(ranges) < 2 * limit):
+            start = i
+            i = self._skip(i, end, False)
+            ranges.append(start)
+            ranges.append(i - start)
+            i = self._skip(i, end, True)
+        return ranges
+
+
+class Transfer:
+    """A download that may take more than one pass: the file on the sender,
+    the sender's CRC32 of it and the ChunkBitmap of what is already in
+    local_path. Saved next to the file, in local_path + '.part', so it can
+    be picked up again after a pass ends or a reboot. A save goes to
+    '.part.tmp' first and is renamed over the old one, so a power cut
+    halfway through leaves one or the other whole.
+    """
+
+    def __init__(self, local_path, remote_path=None, crc=None, received=None):
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.crc = crc
+        self.received = received
+
+    @property
+    def part_path(self):
+        return self.local_path + '.part'
+
+    def save(self):
+        # path length and path, CRC flag and CRC, then the bitmap
+        path = (self.remote_path or '').encode()
+        tmp = self.part_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(bytes((len(path),)))
+            f.write(path)
+            f.write(bytes((self.crc is not None,)))
+            f.write((self.crc or 0).to_bytes(4, 'big'))
+            self.received.write(f)
+        try:
+            os.rename(tmp, self.part_path)
+        except OSError:
+            # FAT won't rename over an existing file. If power goes now
+            # only the .tmp is left, and load() falls back to it.
+            os.remove(self.part_path)
+            os.rename(tmp, self.part_path)
+
+    @classmethod
+    def load(cls, local_path):
+        """The saved state of a download into local_path, None if there
+        isn't one to carry on with"""
+        part_path = local_path + '.part'
+        for path in (part_path, part_path + '.tmp'):
+            try:
+                with open(path, 'rb') as f:
+                    n = f.read(1)[0]
+                    remote_path = f.read(n).decode()
+                    has_crc = f.read(1)[0]
+                    crc = int.from_bytes(f.read(4), 'big')
+                    received = ChunkBitmap.read(f)
+            except (OSError, IndexError, UnicodeError):
+                continue
+            if received is not None:
+                return cls(local_path, remote_path or None, crc if has_crc else None, received)
+        return None
+
+    def remove(self):
+        for path in (self.part_path, self.part_path + '.tmp'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ChunkWriter:
+    """Write-behind for received chunks. Consecutive chunks are gathered
+    and written a block at a time, on block boundaries; a chunk that
+    doesn't follow on starts a new run. The file is synced, and the
+    Transfer saved, every sync_every chunks or sync_interval seconds, so a
+    crash or power cut loses at most what came in since the last sync:
+    those chunks are asked for again.
+    """
+
+    def __init__(self, f, transfer, chunk_size, block_size=4096,
+                 sync_every=64, sync_interval=10):
+        self.f = f
+        self.transfer = transfer
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        # never more than a block and a chunk waiting
+        self._buf = bytearray(block_size + chunk_size)
+        self._len = 0
+        self._start = 0
+        self._pending = 0
+        self._synced = time.monotonic()
+
+    def write(self, packet_num, chunk):
+        offset = packet_num * self.chunk_size
+        if self._len and offset != self._start + self._len:
+            self._flush(self._len)
+        if not self._len:
+            self._start = offset
+        self._buf[self._len:self._len + len(chunk)] = chunk
+        self._len += len(chunk)
+        if self._len >= self.block_size:
+            # up to the last block boundary, the rest waits for the next chunk
+            end = (self._start + self._len) // self.block_size * self.block_size
+            self._flush(end - self._start)
+        self._pending += 1
+        if self._pending >= self.sync_every or time.monotonic() - self._synced >= self.sync_interval:
+            self.sync()
+
+    def _flush(self, n):
+        self.f.seek(self._start)
+        self.f.write(memoryview(self._buf)[:n])
+        rest = self._len - n
+        if rest:
+            self._buf[:rest] = self._buf[n:self._len]
+        self._start += n
+        self._len = rest
+
+    def sync(self):
+        """Write out everything waiting and save the progress"""
+        if not self._pending:
+            return
+        if self._len:
+            self._flush(self._len)
+        self.f.flush()
+        os.sync()
+        # only once the chunks it marks are on the card
+        self.transfer.save()
+        os.sync()
+        self._pending = 0
+        self._synced = time.monotonic()
+
+    def close(self):
+        self.sync()
+        if self.transfer.received.complete:
+            self.transfer.remove()
+
 
 class FileTransferProtocol:
 
     def __init__(self, ptp, log=False):
         self.ptp = ptp
         self.log = log
+        # [cmd, remote path, window]
         self.request_file_cmd = 's'
+        # [cmd, remote path, missing runs, window], resumes a download
         self.request_partial_file_cmd = 'e'
+        # sliding window: the sender polls after every `window` chunks and
+        # the receiver answers with an ACK listing the gaps
+        self.poll_cmd = 'p'
+        self.ack_cmd = 'a'
+        self.window = 32
+        # runs of missing chunks in an ACK or partial file request, so it
+        # fits in one frame (at most 3 bytes of msgpack per number)
+        self.max_ranges = 32
         self.chunk_size = 245
+        # the receiver preallocates and writes files in flash blocks, and
+        # syncs them (and saves its progress in local_path + '.part') every
+        # sync_every chunks or sync_interval seconds
+        self.block_size = 4096
+        self.sync_every = 64
+        self.sync_interval = 10
 
     async def request_file(self, remote_path, local_path, retries=3):
+        """Ask for a file and receive it with the sliding window protocol.
+        If an earlier request for the same file was cut short, only what is
+        still missing is asked for (see resume_file).
+
+        Args:
+            remote_path (str): file on the sender
+            local_path (str): where to put it
+            retries (int, optional): receive timeouts in a row before giving up
+
+        Returns:
+            bool: True if the whole file arrived
+        """
+        transfer = Transfer.load(local_path)
+        if transfer is not None and transfer.remote_path == remote_path:
+            return await self.resume_file(local_path, retries)
         if self.log: print("PyCubed requesting file now")
         await self.ptp.send_packet(
             self.ptp.cmd_packet,
-            [self.request_file_cmd, remote_path],
+            [self.request_file_cmd, remote_path, self.window],
         )
-        missing = await self.receive_file(local_path)
-       
-        while retries:
-            if self.log: print(f"missing: {missing}")
-            if self.log: print(f"retries remaining: {retries}")
-            if missing == set():
-                return True
-            self.ptp.send_packet(
-                self.ptp.cmd_packet,
-                [self.request_partial_file_cmd, remote_path, list(missing)]
-            )
-            missing = await self.receive_partial_file(local_path, missing)
-            retries -= 1
-        return False
+        received = await self.receive_file(local_path, retries, Transfer(local_path, remote_path))
+        if self.log and received is not None: print(f"missing: {received.missing}")
+        return received is not None and received.complete
 
-    async def receive_file(self, local_path):
-        num_packets, sequence_number = await self.ptp.receive_packet()
-        num_packets = abs(num_packets)
-        if self.log: print(f"expecting to receive {num_packets} packets")
-        with open(local_path, 'ab+') as f:
-            missing = {i for i in range(num_packets)}
-            for packet_num in range(num_packets):
-                chunk, packet_num_recvc  = await self.ptp.receive_packet()
-                missing.remove(packet_num_recvc)
-                f.write(chunk)
-                os.sync()
-            return missing
+    async def resume_file(self, local_path, retries=3):
+        """Carry on with a download that was cut short, by a pass ending or
+        a reboot: a partial file request listing the chunks local_path is
+        still missing, then the sliding window from there. False if there
+        is nothing to resume.
+        """
+        transfer = Transfer.load(local_path)
+        if transfer is None or transfer.remote_path is None:
+            return False
+        if self.log: print(f"resuming {transfer.remote_path}, {transfer.received.missing} chunks to go")
+        await self.ptp.send_packet(
+            self.ptp.cmd_packet,
+            # half the runs an ACK carries, leaving room for the path. The
+            # ACKs list the rest.
+            [self.request_partial_file_cmd, transfer.remote_path,
+             transfer.received.missing_ranges(limit=self.max_ranges // 2), self.window],
+        )
+        received = await self.receive_file(local_path, retries, transfer)
+        return received is not None and received.complete
+
+    def _ack(self, received, end):
+        """ACK payload: one past the highest chunk heard so far and the runs
+        of missing chunks below it. Chunks from end on that were sent are
+        lost too, the sender knows how far it got."""
+        return [self.ack_cmd, end, received.missing_ranges(end, self.max_ranges)]
+
+    async def receive_file(self, local_path, retries=3, transfer=None):
+        """Receive chunks in any order, answering the sender's polls (or a
+        receive timeout, in case the poll was lost) with a bitmap ACK.
+        The number of chunks comes in the first packet and in every poll,
+        the CRC of the file in every poll. Stops once a poll finds the file
+        complete or after retries timeouts in a row.
+
+        A transfer with chunks already received carries on with them,
+        unless the sender's file turns out to have changed. Either way the
+        progress is kept in local_path + '.part' until the file is
+        complete and its CRC checks out.
+
+        Returns:
+            ChunkBitmap: the chunks received, None if the sender was never
+                heard
+        """
+        if transfer is None:
+            transfer = Transfer(local_path)
+        received = transfer.received
+        # a resumed transfer asks for runs, any of them can come next
+        resumed = received is not None
+        if resumed:
+            f = open(local_path, 'rb+')
+            end = received.size
+        else:
+            transfer.remove()
+            f = open(local_path, 'wb')
+            end = 0
+        writer = None
+        idle = 0
+        try:
+            while idle < retries:
+                payload, packet_num = await self.ptp.receive_packet()
+                if isinstance(payload, bytes):
+                    idle = 0
+                    # chunks before the number of chunks are dropped, the
+                    # first ACK asks for them again
+                    if received is None or not received.add(packet_num):
+                        continue
+                    end = max(end, packet_num + 1)
+                    if writer is None:
+                        writer = self._writer(f, transfer)
+                    writer.write(packet_num, payload)
+                    continue
+                crc = None
+                if isinstance(payload, int) and payload is not False:
+                    idle = 0
+                    num_packets = abs(payload)
+                elif payload is False:
+                    idle += 1
+                    num_packets = None
+                    if writer is not None:
+                        # nothing coming in, a good time to catch up
+                        writer.sync()
+                elif isinstance(payload, list) and len(payload) == 3 and payload[0] == self.poll_cmd:
+                    idle = 0
+                    num_packets, crc = payload[1], payload[2]
+                else:
+                    continue
+                if received is not None and (
+                        (num_packets is not None and num_packets != received.size)
+                        or (crc is not None and transfer.crc is not None and crc != transfer.crc)):
+                    print("File changed on the sender, starting again")
+                    f.close()
+                    f = open(local_path, 'wb')
+                    received = transfer.received = None
+                    transfer.crc = None
+                    writer = None
+                if crc is not None:
+                    transfer.crc = crc
+                if received is None:
+                    if num_packets is None:
+                        continue
+                    if self.log: print(f"expecting to receive {num_packets} packets")
+                    received = transfer.received = ChunkBitmap(num_packets)
+                    self._preallocate(f, num_packets)
+                    if resumed:
+                        end = num_packets
+                if isinstance(payload, int) and payload is not False:
+                    continue
+                await self.ptp.send_packet(
+                    self.ptp.data_packet,
+                    self._ack(received, end)
+                )
+                if received.complete and payload is not False:
+                    break
+            if writer is not None:
+                writer.sync()
+        finally:
+            f.close()
+        if received is not None and received.complete:
+            if transfer.crc is not None and self._crc(local_path) != transfer.crc:
+                # a chunk went bad somewhere, no way to tell which
+                print(f"{local_path} failed its CRC check, starting again next time")
+                received = transfer.received = ChunkBitmap(received.size)
+            transfer.remove()
+        return received
     
     async def receive_file_sync(self, local_path):
         num_packets, sequence_number = self.ptp.receive_packet_sync()
         num_packets = abs(num_packets)
         if self.log: print(f"expecting to receive {num_packets} packets")
-        with open(local_path, 'ab+') as f:
-            missing = {i for i in range(num_packets)}
+        with open(local_path, 'wb') as f:
+            received = ChunkBitmap(num_packets)
+            self._preallocate(f, num_packets)
+            writer = self._writer(f, Transfer(local_path, received=received))
             for packet_num in range(num_packets):
                 chunk, packet_num_recvc  = self.ptp.receive_packet_sync()
-                missing.remove(packet_num_recvc)
-                f.write(chunk)
-                os.sync()
-            return missing
-
-    async def receive_partial_file(self, local_path, missing):
-        _, _ = await self.ptp.receive_packet()
-        missing_immutable = tuple(missing)
-        for expected_packet_num in missing_immutable:
-            chunk, recv_packet_num  = await self.ptp.receive_packet()
-            missing.remove(int(recv_packet_num))
-            location = self.packet_size * recv_packet_num
-            self.insert_into_file(chunk, local_path, location)
-            os.sync()
-        return missing
-
-    def insert_into_file(self, data, filename, location):
-        """Insert data into a file, and be worried about running out of RAM
-        """
-        with open(filename, 'rb+') as fh:
-            fh.seek(location)
-            with open('tmpfile', 'wb+') as th:
-                for chunk, _ in self._read_chunks(fh, self.chunk_size): 
-                    print(chunk)
-                    th.write(chunk)
-                fh.seek(location)
-                fh.write(data)
-        
-        with open(filename, 'ab+') as fh:
-            fh.seek(location + len(data))
-            with open('tmpfile', 'rb+') as th:
-                for chunk, _ in self._read_chunks(th, self.chunk_size): 
-                    print(chunk)
-                    fh.write(chunk)
-        os.remove('tmpfile')
-
-    async def send_file(self, filename):
+                if received.add(packet_num_recvc):
+                    writer.write(packet_num_recvc, chunk)
+            writer.close()
+            return received
+
+    def _crc(self, path):
+        crc = 0
+        with open(path, 'rb') as f:
+            for chunk, _ in self._read_chunks(f, self.block_size):
+                crc = crc32(chunk, crc)
+        return crc
+
+    def _preallocate(self, f, num_packets):
+        """Grow the file to where the last chunk starts, so every chunk can
+        be written in place at index * chunk_size whatever order it comes
+        in. The last chunk, the only short one, sets the final size."""
+        size = (num_packets - 1) * self.chunk_size
+        f.seek(0, 2)
+        pos = f.tell()
+        zeros = bytes(self.block_size)
+        while pos < size:
+            n = min(self.block_size - pos % self.block_size, size - pos)
+            f.write(zeros[:n] if n < self.block_size else zeros)
+            pos += n
+
+    def _writer(self, f, transfer):
+        return ChunkWriter(f, transfer, self.chunk_size, self.block_size,
+                           self.sync_every, self.sync_interval)
+
+    async def send_file(self, filename, window=None, retries=3, missing=None):
         """Send a file
 
         Args:
             filename (str): path to file that will be sent
-            chunk_size (int, optional): chunk sizes that will be sent. Defaults to 64.
+            window (int, optional): chunks sent between polls for an ACK,
+                as asked for in the request. Each window starts with the
+                gaps the last ACK reported and carries on with new chunks.
+                None sends every chunk once.
+            retries (int, optional): unanswered polls before giving up
+            missing (list, optional): the runs of chunks a partial file
+                request asked for. Only those are sent, and whatever the
+                ACKs report missing after them.
+
+        Returns:
+            bool: True once the receiver has every chunk (always True
+                without a window)
         """
         with open(filename, 'rb') as f:
             stats = os.stat(filename)
             filesize = stats[6]
+            num_packets = math.ceil(filesize / self.chunk_size)
+            crc = 0
+            if window is not None:
+                for chunk, _ in self._read_chunks(f, self.block_size):
+                    crc = crc32(chunk, crc)
             
             # send the number of packets for the client
             print("sending number of packets!!!!!")
             await self.ptp.send_packet(
                 self.ptp.data_packet,
-                 - math.ceil(filesize / self.chunk_size)
+                 - num_packets
             )
 
-            # send all the chunks
-            for chunk, packet_num in self._read_chunks(f, self.chunk_size):
-                await self.ptp.send_packet(
-                    self.ptp.data_packet,
-                    chunk,
-                    packet_num
-                )
+            if window is None and missing is None:
+                # send all the chunks
+                f.seek(0)
+                for chunk, packet_num in self._read_chunks(f, self.chunk_size):
+                    await self.ptp.send_packet(
+                        self.ptp.data_packet,
+                        chunk,
+                        packet_num
+                    )
+                return True
+
+            gaps = [] if missing is None else list(missing)
+            # a partial request leaves nothing new to send
+            next_packet = 0 if missing is None else num_packets
+            polled = window is not None
+            if not polled:
+                window = num_packets
+            while True:
+                batch = []
+                for n in range(0, len(gaps), 2):
+                    for packet_num in range(gaps[n], min(gaps[n] + gaps[n + 1], num_packets)):
+                        if len(batch) >= window:
+                            break
+                        batch.append(packet_num)
+                while len(batch) < window and next_packet < num_packets:
+                    batch.append(next_packet)
+                    next_packet += 1
+                for packet_num in batch:
+                    f.seek(packet_num * self.chunk_size)
+                    await self.ptp.send_packet(
+                        self.ptp.data_packet,
+                        f.read(self.chunk_size),
+                        packet_num
+                    )
+                if not polled:
+                    return True
+                ack = await self._poll(num_packets, crc, retries)
+                if ack is None:
+                    return False
+                end, gaps = ack
+                if end >= num_packets and not gaps:
+                    return True
+                if next_packet > end:
+                    # lost off the end of the last window
+                    gaps.append(end)
+                    gaps.append(next_packet - end)
+
+    async def _poll(self, num_packets, crc, retries):
+        """Ask the receiver for an ACK, (end, missing runs) or None"""
+        for _ in range(retries):
+            await self.ptp.send_packet(self.ptp.data_packet, [self.poll_cmd, num_packets, crc])
+            payload, _ = await self.ptp.receive_packet()
+            if isinstance(payload, list) and len(payload) == 3 and payload[0] == self.ack_cmd:
+                return payload[1], payload[2]
+        return None
 
     def send_file_sync(self, filename):
         """Send a file
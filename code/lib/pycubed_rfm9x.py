@@ -33,6 +33,7 @@ http: www.airspayce.com/mikem/arduino/RadioHead/
 """
 import time
 from random import random
+import asyncio
 import digitalio
 from micropython import const
 import adafruit_bus_device.spi_device as spidev
@@ -94,6 +95,27 @@ _RH_RF95_DETECTION_THRESHOLD = const(0x37)
 _RH_RF95_PA_DAC_DISABLE = const(0x04)
 _RH_RF95_PA_DAC_ENABLE = const(0x07)
 
+# Configuration registers that only change when the driver writes them, so a
+# RAM copy can stand in for the chip (see RFM9x shadow_registers). Volatile
+# registers (FIFO, FIFO_ADDR_PTR, IRQ_FLAGS, RX_NB_BYTES, RSSI/SNR, MODEM_STAT,
+# ...) must never be added here.
+_SHADOWABLE = bytearray(0x80)
+for _reg in (_RH_RF95_REG_01_OP_MODE, _RH_RF95_REG_06_FRF_MSB,
+             _RH_RF95_REG_07_FRF_MID, _RH_RF95_REG_08_FRF_LSB,
+             _RH_RF95_REG_09_PA_CONFIG, _RH_RF95_REG_0A_PA_RAMP,
+             _RH_RF95_REG_0B_OCP, _RH_RF95_REG_0C_LNA,
+             _RH_RF95_REG_0E_FIFO_TX_BASE_ADDR, _RH_RF95_REG_0F_FIFO_RX_BASE_ADDR,
+             _RH_RF95_REG_11_IRQ_FLAGS_MASK, _RH_RF95_REG_1D_MODEM_CONFIG1,
+             _RH_RF95_REG_1E_MODEM_CONFIG2, _RH_RF95_REG_1F_SYMB_TIMEOUT_LSB,
+             _RH_RF95_REG_20_PREAMBLE_MSB, _RH_RF95_REG_21_PREAMBLE_LSB,
+             _RH_RF95_REG_22_PAYLOAD_LENGTH, _RH_RF95_REG_23_MAX_PAYLOAD_LENGTH,
+             _RH_RF95_REG_24_HOP_PERIOD, _RH_RF95_REG_26_MODEM_CONFIG3,
+             _RH_RF95_DETECTION_OPTIMIZE, _RH_RF95_DETECTION_THRESHOLD,
+             _RH_RF95_REG_40_DIO_MAPPING1, _RH_RF95_REG_41_DIO_MAPPING2,
+             _RH_RF95_REG_4D_PA_DAC):
+    _SHADOWABLE[_reg] = 1
+del _reg
+
 # The Frequency Synthesizer step = RH_RF95_FXOSC / 2^^19
 _RH_RF95_FSTEP = 32000000 / 524288
 
@@ -115,6 +137,10 @@ FS_RX_MODE  = const(4)#0b100
 RX_MODE     = const(5)#0b101
 # pylint: enable=bad-whitespace
 
+# Poll intervals (ms) for the async send/receive wait loops
+_DIO0_POLL_MS = const(1)
+_SPI_POLL_MS = const(10)
+
 # gap =bytes([0xFF])
 # sgap=bytes([0xFF,0xFF,0xFF])
 # dot =bytes([0])
@@ -134,6 +160,8 @@ VR3X=b'\xff\x00\xff\x00\xff\x00\xff\x00\x00\x00\xff\xff\xff\x00\xff\x00\x00\x00\
 # pylint: disable=too-many-instance-attributes
 
 _bigbuffer=bytearray(256)
+# resync() has its own so it can't clobber a packet being read out of the FIFO
+_syncbuffer=bytearray(_RH_RF95_REG_26_MODEM_CONFIG3)
 bw_bins = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000)
 class RFM9x:
     """Interface to a RFM95/6/7/8 LoRa radio module.  Allows sending and
@@ -152,6 +180,9 @@ class RFM9x:
     is True for high power.
     - baudrate: Baud rate of the SPI connection, default is 10mhz but you might
     choose to lower to 1mhz if using long wires or a breadboard.
+    - shadow_registers: Keep a RAM copy of the configuration registers so
+    reads are served without SPI traffic and writes that don't change a
+    register are skipped. Default is False.
 
     Remember this library makes a best effort at receiving packets with pure
     Python code.  Trying to receive packets too quickly will result in lost data
@@ -170,6 +201,10 @@ class RFM9x:
 
     # Global buffer for SPI commands
     _BUFFER = bytearray(4)
+    # Scratch for configure(): MODEM_CONFIG1 (0x1D) through MODEM_CONFIG3 (0x26)
+    _MODEM_BLOCK = bytearray(10)
+    # Scratch for FRF_MSB (0x06) through FRF_LSB (0x08)
+    _FRF_BLOCK = bytearray(3)
     DEBUG_HEADER=False
     valid_ids  = (58,59,60,255)
     class _RegisterBits:
@@ -258,10 +293,21 @@ class RFM9x:
         code_rate=5,
         high_power=True,
         baudrate=5000000,
-        rfm95pw=False
+        rfm95pw=False,
+        shadow_registers=False
     ):
         self.high_power = high_power
+        # Register shadow (None when disabled). _shadow_valid marks which
+        # entries of _shadow currently mirror the chip.
+        self._shadow = None
+        self._shadow_valid = None
+        if shadow_registers:
+            self._shadow = bytearray(0x80)
+            self._shadow_valid = bytearray(0x80)
         self.RFM95PW=rfm95pw
+        # Optional DigitalInOut input wired to the radio's DIO0/IRQ line. When
+        # set, the async send/receive wait on the pin instead of polling
+        # IRQ_FLAGS over SPI.
         self.dio0=False
         self.debug=True
         # Device support SPI mode 0 (polarity & phase = 0) up to a max of 10mhz.
@@ -306,16 +352,17 @@ class RFM9x:
         self.idle()
 
 
-        # Set frequency
-        self.frequency_mhz = frequency
-        # Set preamble length (default 8 bytes to match radiohead).
-        self.preamble_length = preamble_length
-        # Defaults set modem config to RadioHead compatible Bw125Cr45Sf128 mode.
-        self.signal_bandwidth = 125000
-        self.coding_rate = code_rate
-        self.spreading_factor = 7
-        # Default to disable CRC checking on incoming packets.
-        self.enable_crc = False
+        # Set frequency, preamble length (default 8 bytes to match radiohead)
+        # and RadioHead compatible Bw125Cr45Sf128 modem config. Default to
+        # disable CRC checking on incoming packets.
+        self.configure({
+            'FREQ': frequency,
+            'PREAMBLE': preamble_length,
+            'BW': 125000,
+            'CR': code_rate,
+            'SF': 7,
+            'CRC': False,
+        })
         # Note no sync word is set for LoRa mode either!
         self._write_u8(_RH_RF95_REG_26_MODEM_CONFIG3, 0x00)
         # Set transmit power to 13 dBm, a safe value any module supports.
@@ -326,6 +373,8 @@ class RFM9x:
            This instantaneous RSSI value may not be accurate once the
            operating mode has been changed.
         """
+        self.last_snr = 0.0
+        """The SNR (dB) of the last received packet. Stored when the packet was received."""
         # initialize timeouts and delays delays
         self.ack_wait = 0.5
         """The delay time before attempting a retry after not receiving an ACK"""
@@ -394,6 +443,8 @@ class RFM9x:
         self.operation_mode = SLEEP_MODE
         time.sleep(0.01)
         self.long_range_mode=False # FSK/OOK Mode
+        # registers 0x0D-0x3F mean something else in FSK mode
+        self.invalidate()
         self.modulation_type=1 # OOK
         self.modulation_shaping = 2
         self._write_u8(0x25,0x00) # no preamble
@@ -424,6 +475,7 @@ class RFM9x:
             self.operation_mode = SLEEP_MODE
             time.sleep(0.01)
             self.long_range_mode = True
+            self.invalidate()
             self._write_u8(_RH_RF95_REG_0E_FIFO_TX_BASE_ADDR, 0x00)
             self._write_u8(_RH_RF95_REG_0F_FIFO_RX_BASE_ADDR, 0x00)
             self._write_u8(_RH_RF95_REG_24_HOP_PERIOD, 0x00)
@@ -459,9 +511,18 @@ class RFM9x:
             # value (read).
             device.write(self._BUFFER, end=1)
             device.readinto(buf, end=length)
+        if self._shadow is not None and address != _RH_RF95_REG_00_FIFO:
+            # burst reads auto-increment, so refresh every shadowed register
+            # the transfer covered
+            for i in range(length):
+                if _SHADOWABLE[address + i]:
+                    self._shadow[address + i] = buf[i]
+                    self._shadow_valid[address + i] = 1
 
     def _read_u8(self, address):
         # Read a single byte from the provided address and return it.
+        if self._shadow is not None and self._shadow_valid[address]:
+            return self._shadow[address]
         self._read_into(address, self._BUFFER, length=1)
         return self._BUFFER[0]
 
@@ -471,15 +532,34 @@ class RFM9x:
         # buffer is written.
         if length is None:
             length = len(buf)
+        if self._shadow is not None and address != _RH_RF95_REG_00_FIFO:
+            # skip the transfer if the chip already holds every byte
+            for i in range(length):
+                if not (self._shadow_valid[address + i]
+                        and self._shadow[address + i] == buf[i]):
+                    break
+            else:
+                return
         with self._device as device:
             self._BUFFER[0] = (address | 0x80) & 0xFF  # Set top bit to 1 to
             # indicate a write.
             device.write(self._BUFFER, end=1)
             device.write(buf, end=length)
+        if self._shadow is not None and address != _RH_RF95_REG_00_FIFO:
+            for i in range(length):
+                if _SHADOWABLE[address + i]:
+                    self._shadow[address + i] = buf[i]
+                    self._shadow_valid[address + i] = 1
 
     def _write_u8(self, address, val):
         # Write a byte register to the chip.  Specify the 7-bit address and the
         # 8-bit value to write to that address.
+        if self._shadow is not None and _SHADOWABLE[address]:
+            val &= 0xFF
+            if self._shadow_valid[address] and self._shadow[address] == val:
+                return  # chip already holds this value
+            self._shadow[address] = val
+            self._shadow_valid[address] = 1
         with self._device as device:
             self._BUFFER[0] = (address | 0x80) & 0xFF  # Set top bit to 1 to
             # indicate a write.
@@ -493,6 +573,33 @@ class RFM9x:
         time.sleep(0.0001)  # 100 us
         self._reset.switch_to_input(pull=digitalio.Pull.UP)
         time.sleep(0.005)  # 5 ms
+        # every register is back at its power-on default
+        self.invalidate()
+
+    def invalidate(self, address=None):
+        """Mark the register shadow stale so the next access goes to the chip.
+        Invalidates a single register if address is given, otherwise all of
+        them. No-op when shadow_registers is disabled.
+        """
+        if self._shadow is None:
+            return
+        if address is None:
+            for i in range(len(self._shadow_valid)):
+                self._shadow_valid[i] = 0
+        else:
+            self._shadow_valid[address] = 0
+
+    def resync(self):
+        """Reload the register shadow from the chip. Use after anything other
+        than this driver has touched the radio's configuration.
+        """
+        if self._shadow is None:
+            return
+        self.invalidate()
+        # one burst covers OP_MODE through MODEM_CONFIG3, the rest are
+        # refreshed on first access
+        self._read_into(_RH_RF95_REG_01_OP_MODE, _syncbuffer,
+                        length=_RH_RF95_REG_26_MODEM_CONFIG3)
 
     def idle(self):
         """Enter idle standby mode."""
@@ -538,11 +645,7 @@ class RFM9x:
         """The frequency of the radio in Megahertz. Only the allowed values for
         your radio must be specified (i.e. 433 vs. 915 mhz)!
         """
-        msb = self._read_u8(_RH_RF95_REG_06_FRF_MSB)
-        mid = self._read_u8(_RH_RF95_REG_07_FRF_MID)
-        lsb = self._read_u8(_RH_RF95_REG_08_FRF_LSB)
-        frf = ((msb << 16) | (mid << 8) | lsb) & 0xFFFFFF
-        frequency = (frf * _RH_RF95_FSTEP) / 1000000.0
+        frequency = (self.frf * _RH_RF95_FSTEP) / 1000000.0
         return frequency
 
     @frequency_mhz.setter
@@ -550,14 +653,26 @@ class RFM9x:
         if val < 240 or val > 960:
             raise RuntimeError("frequency_mhz must be between 240 and 960")
         # Calculate FRF register 24-bit value.
-        frf = int((val * 1000000.0) / _RH_RF95_FSTEP) & 0xFFFFFF
-        # Extract byte values and update registers.
-        msb = frf >> 16
-        mid = (frf >> 8) & 0xFF
-        lsb = frf & 0xFF
-        self._write_u8(_RH_RF95_REG_06_FRF_MSB, msb)
-        self._write_u8(_RH_RF95_REG_07_FRF_MID, mid)
-        self._write_u8(_RH_RF95_REG_08_FRF_LSB, lsb)
+        self.frf = int((val * 1000000.0) / _RH_RF95_FSTEP) & 0xFFFFFF
+
+    @property
+    def frf(self):
+        """The raw 24-bit FRF register value, frequency = frf * 32 MHz / 2^19."""
+        msb = self._read_u8(_RH_RF95_REG_06_FRF_MSB)
+        mid = self._read_u8(_RH_RF95_REG_07_FRF_MID)
+        lsb = self._read_u8(_RH_RF95_REG_08_FRF_LSB)
+        return ((msb << 16) | (mid << 8) | lsb) & 0xFFFFFF
+
+    @frf.setter
+    def frf(self, frf):
+        # All three bytes in one burst: a retune is a single SPI transaction
+        # and the chip applies the new frequency as FRF_LSB, the last byte,
+        # is written. Skipped by the shadow when nothing changed.
+        block = self._FRF_BLOCK
+        block[0] = (frf >> 16) & 0xFF
+        block[1] = (frf >> 8) & 0xFF
+        block[2] = frf & 0xFF
+        self._write_from(_RH_RF95_REG_06_FRF_MSB, block, length=3)
 
     @property
     def tx_power(self):
@@ -697,7 +812,7 @@ class RFM9x:
         val = min(max(val, 6), 12)
         self._write_u8(_RH_RF95_DETECTION_OPTIMIZE, 0xC5 if val == 6 else 0xC3)
 
-        if self.signal_bandwidth >= 5000000:
+        if self.signal_bandwidth >= 500000:
             self._write_u8(_RH_RF95_DETECTION_OPTIMIZE, 0xC5 if val == 6 else 0xC3)
         else:
             # see Semtech SX1276 errata note 2.3
@@ -734,6 +849,80 @@ class RFM9x:
                 self._read_u8(_RH_RF95_REG_1E_MODEM_CONFIG2) & 0xFB,
             )
 
+    def configure(self, profile):
+        """Apply a modem profile in as few SPI transfers as possible.
+        profile is a dict using the GroundStation.SATELLITE keys:
+        - FREQ: frequency in MHz
+        - SF, BW, CR: spreading factor, signal bandwidth (Hz), coding rate
+        - PREAMBLE: preamble length
+        - CRC: enable_crc
+        - LDRO: low_datarate_optimize
+        Keys that are missing leave the current setting untouched. The end
+        state matches setting the equivalent properties one at a time, but
+        the register values are computed up front and written as bursts
+        (the chip auto-increments the address). Puts the radio in standby.
+        """
+        self.idle()
+        if 'FREQ' in profile:
+            self.frequency_mhz = profile['FREQ']
+
+        # MODEM_CONFIG1 .. MODEM_CONFIG3 in one read and one write, keeping
+        # whatever the profile doesn't cover (header mode, symbol timeout,
+        # payload lengths, hop period)
+        block = self._MODEM_BLOCK
+        self._read_into(_RH_RF95_REG_1D_MODEM_CONFIG1, block)
+        if 'BW' in profile:
+            bw = profile['BW']
+            for bw_id, cutoff in enumerate(bw_bins):
+                if bw <= cutoff:
+                    break
+            else:
+                bw_id = 9
+            block[0] = (block[0] & 0x0F) | (bw_id << 4)
+        else:
+            bw_id = block[0] >> 4
+            bw = bw_bins[bw_id] if bw_id < len(bw_bins) else 500000
+        if 'CR' in profile:
+            cr_id = min(max(profile['CR'], 5), 8) - 4
+            block[0] = (block[0] & 0xF1) | (cr_id << 1)
+        if 'SF' in profile:
+            sf = min(max(profile['SF'], 6), 12)
+            block[1] = (block[1] & 0x0F) | ((sf << 4) & 0xF0)
+        else:
+            sf = block[1] >> 4
+        if 'CRC' in profile:
+            block[1] = (block[1] | 0x04) if profile['CRC'] else (block[1] & 0xFB)
+        if 'PREAMBLE' in profile:
+            val = profile['PREAMBLE']
+            assert 0 <= val <= 65535
+            block[3] = (val >> 8) & 0xFF
+            block[4] = val & 0xFF
+        if 'LDRO' in profile:
+            block[9] = (block[9] & 0xF7) | (bool(profile['LDRO']) << 3)
+        self._write_from(_RH_RF95_REG_1D_MODEM_CONFIG1, block)
+
+        if 'BW' not in profile and 'SF' not in profile:
+            return
+        # bandwidth/spreading factor dependent tuning
+        if bw >= 500000:
+            # see Semtech SX1276 errata note 2.1
+            self._write_u8(0x36, 0x02)
+            self._write_u8(0x3a, 0x64)
+            self._write_u8(_RH_RF95_DETECTION_OPTIMIZE, 0xC5 if sf == 6 else 0xC3)
+        else:
+            # 0x2F, 0x30 and DETECTION_OPTIMIZE (0x31) are contiguous
+            if bw == 7800:
+                block[0] = 0x48
+            elif bw >= 62500:
+                # see Semtech SX1276 errata note 2.3
+                block[0] = 0x40
+            else:
+                block[0] = 0x44
+            block[1] = 0
+            block[2] = 0x45 if sf == 6 else 0x43
+            self._write_from(0x2F, block, length=3)
+        self._write_u8(_RH_RF95_DETECTION_THRESHOLD, 0x0C if sf == 6 else 0x0A)
+
     def tx_done(self):
         """Transmit status"""
         # if self.dio0:
@@ -753,6 +942,18 @@ class RFM9x:
         """crc status"""
         return (self._read_u8(_RH_RF95_REG_12_IRQ_FLAGS) & 0x20) >> 5
 
+    def receiving(self):
+        """True while a packet is coming in (RegModemStat: signal detected,
+        synchronized, RX ongoing or header valid). Retuning then loses it."""
+        return bool(self._read_u8(_RH_RF95_REG_18_MODEM_STAT) & 0x0F)
+
+    def _tx_finished(self):
+        # The chip drops back to standby by itself once TxDone fires, keep the
+        # shadowed OP_MODE in step with it.
+        if self._shadow is not None and self._shadow_valid[_RH_RF95_REG_01_OP_MODE]:
+            self._shadow[_RH_RF95_REG_01_OP_MODE] = (
+                self._shadow[_RH_RF95_REG_01_OP_MODE] & ~7) | STANDBY_MODE
+
     def send(
         self,
         data,
@@ -776,6 +977,40 @@ class RFM9x:
 
            Returns: True if success or False if the send timed out.
         """
+        self._start_send(data, destination, node, identifier, flags)
+        # Wait for tx done interrupt with explicit polling (not ideal but
+        # best that can be done right now without interrupts).
+        start = time.monotonic()
+        timed_out = False
+        while not timed_out and not self.tx_done():
+            if (time.monotonic() - start) >= self.xmit_timeout:
+                timed_out = True
+        return self._finish_send(timed_out, keep_listening)
+
+    async def send_async(
+        self,
+        data,
+        *,
+        keep_listening=False,
+        destination=None,
+        node=None,
+        identifier=None,
+        flags=None,
+        poll_ms=None
+    ):
+        """Coroutine version of :py:func:`send` for the asyncio loop.
+           Waits for TxDone on the DIO0 pin if one is attached (see dio0),
+           otherwise polls the IRQ flags every poll_ms milliseconds, yielding
+           to other tasks in between.
+
+           Returns: True if success or False if the send timed out.
+        """
+        self._start_send(data, destination, node, identifier, flags)
+        done = await self._wait_irq(self.tx_done, self.xmit_timeout, poll_ms)
+        return self._finish_send(not done, keep_listening)
+
+    def _start_send(self, data, destination, node, identifier, flags):
+        # Load the FIFO with header + data and switch to transmit mode.
         # Disable pylint warning to not use length as a check for zero.
         # This is a puzzling warning as the below code is clearly the most
         # efficient and proper way to ensure a precondition that the provided
@@ -833,13 +1068,10 @@ class RFM9x:
         self._write_u8(_RH_RF95_REG_22_PAYLOAD_LENGTH, l)
         # Turn on transmit mode to send out the packet.
         self.transmit()
-        # Wait for tx done interrupt with explicit polling (not ideal but
-        # best that can be done right now without interrupts).
-        start = time.monotonic()
-        timed_out = False
-        while not timed_out and not self.tx_done():
-            if (time.monotonic() - start) >= self.xmit_timeout:
-                timed_out = True
+
+    def _finish_send(self, timed_out, keep_listening):
+        if not timed_out:
+            self._tx_finished()
 
         if hasattr(self,'txrx'): # RX
             self.txrx[0].value=False
@@ -932,6 +1164,79 @@ class RFM9x:
             while not timed_out and not self.rx_done():
                 if (time.monotonic() - start) >= timeout:
                     timed_out = True
+        return self._finish_receive(timed_out, keep_listening, with_header, with_ack, debug, view)
+
+    async def receive_async(
+        self, *, keep_listening=True, with_header=False, with_ack=False, timeout=None, debug=False, view=False, poll_ms=None):
+        """Coroutine version of :py:func:`receive` for the asyncio loop.
+           Waits for RxDone on the DIO0 pin if one is attached (see dio0),
+           otherwise polls the IRQ flags every poll_ms milliseconds, yielding
+           to other tasks in between. Arguments and return value match receive().
+           An ACK requested with with_ack is still sent synchronously.
+        """
+        if hasattr(self,'txrx'): # RX
+            self.txrx[0].value=False
+            self.txrx[1].value=True
+
+        if timeout is None:
+            timeout = self.receive_timeout
+        timed_out = False
+        if timeout is not None:
+            self.listen()
+            timed_out = not await self._wait_irq(self.rx_done, timeout, poll_ms)
+        return self._finish_receive(timed_out, keep_listening, with_header, with_ack, debug, view)
+
+    async def wait_rx_async(self, timeout, poll_ms=None):
+        """Wait up to timeout seconds for RxDone without touching the operating
+           mode, so a radio left in RX continuous never stops listening.
+           Returns True if a packet is waiting, fetch it with read_fifo().
+        """
+        return await self._wait_irq(self.rx_done, timeout, poll_ms)
+
+    def read_fifo(self):
+        """Read the last received packet out of the FIFO and clear the IRQ
+           flags, staying in RX continuous. Unlike receive() there are no
+           header, length or address checks: every frame the radio heard is
+           returned, as (packet, crc_ok). packet is a view into the buffer
+           shared by all radios (copy it before the next read) or None if the
+           FIFO was empty.
+        """
+        self.last_rssi = self.rssi(raw=True)
+        snr = self._read_u8(_RH_RF95_REG_19_PKT_SNR_VALUE)
+        self.last_snr = (snr - 256 if snr > 127 else snr) / 4
+        crc_ok = not self.crc_error()
+        if not crc_ok:
+            self.crc_error_count += 1
+        packet = None
+        fifo_length = self._read_u8(_RH_RF95_REG_13_RX_NB_BYTES)
+        if fifo_length > 0:
+            current_addr = self._read_u8(_RH_RF95_REG_10_FIFO_RX_CURRENT_ADDR)
+            self._write_u8(_RH_RF95_REG_0D_FIFO_ADDR_PTR, current_addr)
+            packet = self.buffview[:fifo_length]
+            self._read_into(_RH_RF95_REG_00_FIFO, packet)
+        # Clear interrupt, this also releases DIO0.
+        self._write_u8(_RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
+        return packet, crc_ok
+
+    async def _wait_irq(self, flag, timeout, poll_ms=None):
+        # Wait until DIO0 goes high (or flag() reports the IRQ when no pin is
+        # attached) or timeout seconds pass. Returns True if the IRQ fired.
+        # Checking the pin is a GPIO read so it can be polled much faster
+        # than the IRQ register, which costs an SPI transaction each time.
+        if poll_ms is None:
+            poll_ms = _DIO0_POLL_MS if self.dio0 else _SPI_POLL_MS
+        start = time.monotonic()
+        while True:
+            if self.dio0:
+                if self.dio0.value:
+                    return True
+            elif flag():
+                return True
+            if (time.monotonic() - start) >= timeout:
+                return False
+            await asyncio.sleep_ms(poll_ms)
+
+    def _finish_receive(self, timed_out, keep_listening, with_header, with_ack, debug, view):
         # Payload ready is set, a packet is in the FIFO.
         packet = None
         # save last RSSI reading
@@ -939,6 +1244,8 @@ class RFM9x:
         # Enter idle mode to stop receiving other packets.
         self.idle()
         if not timed_out:
+            snr = self._read_u8(_RH_RF95_REG_19_PKT_SNR_VALUE)
+            self.last_snr = (snr - 256 if snr > 127 else snr) / 4
             if self.enable_crc and self.crc_error():
                 self.crc_error_count += 1
                 print('crc error')
@@ -1092,8 +1399,10 @@ class RFM9x:
         # Wait for tx done interrupt with explicit polling (not ideal but
         # best that can be done right now without interrupts).
         _t = time.monotonic() + 5
-        while time.monotonic() < _t and not self.tx_done():
-            pass
+        while time.monotonic() < _t:
+            if self.tx_done():
+                self._tx_finished()
+                break
         self.idle()
         # Clear interrupt.
         self._write_u8(_RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
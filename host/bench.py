@@ -0,0 +1,324 @@
+"""
+Benchmark the radio -> MQTT hot path on the host.
+
+Frames are injected into the simulated radios (host/sx127x.py) and pushed
+through the same code the station runs: GroundStation.get_msg2() (the deep
+sleep wake path) or RFM9x.receive() (the listening path), the
+DiversityCombiner, make_message() from code.py, json.dumps() and
+MQTT.publish() to a throwaway broker on a local socket.
+
+    python host/bench.py --packets 2000 --out bench.json
+
+Reports packets/sec, per stage latency percentiles, SPI transactions and
+bytes per packet and per stage peak allocations (tracemalloc, on a second,
+shorter pass) as JSON.
+"""
+import argparse
+import json
+import os
+import platform
+import runpy
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+import emulate
+
+STAGES = ('rx', 'combine', 'message', 'json', 'publish')
+
+
+class MQTTSink:
+    """Broker that accepts one client, acks what it sends and throws the
+    messages away, counting PUBLISH packets and bytes."""
+
+    def __init__(self):
+        self._server = socket.socket()
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(1)
+        self.port = self._server.getsockname()[1]
+        self.publishes = 0
+        self.bytes = 0
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _read(self, conn, n):
+        data = b''
+        while len(data) < n:
+            chunk = conn.recv(n - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _serve(self):
+        conn, _ = self._server.accept()
+        with conn:
+            try:
+                while True:
+                    kind = self._read(conn, 1)[0]
+                    length = shift = 0
+                    while True:
+                        byte = self._read(conn, 1)[0]
+                        length |= (byte & 0x7F) << shift
+                        shift += 7
+                        if not byte & 0x80:
+                            break
+                    body = self._read(conn, length)
+                    self.bytes += 1 + length
+                    if kind >> 4 == 1:  # CONNECT
+                        conn.sendall(b'\x20\x02\x00\x00')
+                    elif kind >> 4 == 3:  # PUBLISH
+                        self.publishes += 1
+                        if kind & 0x06:
+                            # QoS 1 PUBACK, QoS 2 PUBREC the packet id after the topic
+                            topic_len = struct.unpack_from('!H', body)[0]
+                            ack = b'\x40\x02' if kind & 0x06 == 0x02 else b'\x50\x02'
+                            conn.sendall(ack + body[2 + topic_len:4 + topic_len])
+                    elif kind >> 4 == 6:  # PUBREL
+                        conn.sendall(b'\x70\x02' + body[:2])
+                    elif kind >> 4 == 8:  # SUBSCRIBE
+                        conn.sendall(b'\x90\x03' + body[:2] + b'\x00')
+                    elif kind >> 4 == 12:  # PINGREQ
+                        conn.sendall(b'\xd0\x00')
+                    elif kind >> 4 == 14:  # DISCONNECT
+                        return
+            except (EOFError, OSError):
+                return
+
+    def close(self):
+        self._server.close()
+
+
+def percentiles(samples):
+    """Latency summary in microseconds."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1e6, 1)
+
+    return {
+        'mean_us': round(sum(ordered) / len(ordered) * 1e6, 1),
+        'p50_us': pick(0.50),
+        'p90_us': pick(0.90),
+        'p99_us': pick(0.99),
+        'max_us': round(ordered[-1] * 1e6, 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=emulate.HOST_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Pipeline:
+    """The station's receive path set up against simulated radios."""
+
+    def __init__(self, args, port):
+        import board
+        import socketpool
+        import wifi
+        from sx127x import SX1276
+
+        self.args = args
+        self.sims = []
+        spi = board.SPI()
+        # frames land as soon as they are injected: measure the code, not the air
+        for cs, rst, dio0 in ((board.D5, board.D6, board.IO5),
+                              (board.D20, board.D21, board.IO6),
+                              (board.D12, board.D13, board.IO7)):
+            sim = SX1276(dio0=dio0, reset=rst, time_on_air=lambda length: 0)
+            spi.attach(cs, sim)
+            self.sims.append(sim)
+
+        # code.py's functions without running main()
+        self.code = runpy.run_path(os.path.join(emulate.CODE_DIR, 'code.py'), run_name='pygs_bench')
+        GS = self.GS = self.code['GS']
+        GS.id = self.code['ID']
+        self.radios = GS.init_radios(self.code['SAT']) or GS.radios
+        GS.gs_listen()
+        self.chip_selects = {1: GS.R1_CS, 2: GS.R2_CS, 3: GS.R3_CS}
+
+        wifi.radio.connect('bench', 'bench')
+        MQTT = self.code['MQTT']
+        self.mqtt = MQTT.MQTT(broker='127.0.0.1', port=port,
+                              socket_pool=socketpool.SocketPool(wifi.radio))
+        self.topic = self.code['DATA_TOPIC']
+        self.combiner = self.code['DiversityCombiner']()
+        self._count = 0
+
+    def inject(self):
+        """Put the next frame on the air for the configured radios."""
+        self._count += 1
+        # broadcast RadioHead header, then a payload that differs per frame
+        payload = b'\xff\xab' + self._count.to_bytes(2, 'big') + b'\x00'
+        payload += bytes((self._count + i) & 0xFF for i in range(self.args.size - len(payload)))
+        for n, sim in enumerate(self.sims[:self.args.radios]):
+            sim.inject(payload, rssi=-90 - 3 * n, snr=7.5)
+
+    def rx(self):
+        copies = []
+        if self.args.rx == 'get_msg2':
+            GS = self.GS
+            for r, cs in self.chip_selects.items():
+                if GS.rx_done(cs):
+                    for msg in GS.get_msg2(cs):
+                        if msg is not None:
+                            copies.append((r, msg, GS.last_rssi, GS.last_crc_ok))
+        else:
+            for radio in self.radios:
+                if radio.rx_done():
+                    msg = radio.receive(keep_listening=True, with_header=True, timeout=0.1)
+                    if msg is not None:
+                        copies.append((radio.name, msg, radio.last_rssi - 164, True))
+        return copies
+
+    def combine(self, copies):
+        for r, msg, rssi, crc_ok in copies:
+            self.combiner.add(r, msg, rssi, crc_ok)
+        return self.combiner.flush(force=True)
+
+    def message(self, frames):
+        if self.args.raw:
+            return frames
+        return [self.code['make_message'](frame) for frame in frames]
+
+    def json(self, messages):
+        if self.args.raw:
+            return [frame.data for frame in messages]
+        return ["Message received: " + json.dumps(msg) for msg in messages]
+
+    async def publish(self, payloads):
+        for payload in payloads:
+            await self.mqtt.publish(self.topic, payload, qos=self.args.qos)
+        return len(payloads)
+
+    async def step(self, timings=None, allocations=None):
+        """One frame through every stage. Returns the number of frames published."""
+        self.inject()
+        data = None
+        start = time.perf_counter()
+        for stage in STAGES:
+            if allocations is not None:
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+            t = time.perf_counter()
+            data = getattr(self, stage)() if data is None else getattr(self, stage)(data)
+            if hasattr(data, 'send'):
+                data = await data
+            if timings is not None:
+                timings[stage].append(time.perf_counter() - t)
+            if allocations is not None:
+                allocations[stage] = max(allocations[stage], tracemalloc.get_traced_memory()[1] - base)
+        if timings is not None:
+            timings['end_to_end'].append(time.perf_counter() - start)
+        return data
+
+    async def run(self):
+        """Warm up, then the timed pass and the tracemalloc pass."""
+        import asyncio
+
+        await self.mqtt.connect()
+        for _ in range(self.args.warmup):
+            await self.step()
+
+        timings = {stage: [] for stage in STAGES + ('end_to_end',)}
+        self.reset_counters()
+        published = 0
+        start = time.perf_counter()
+        for _ in range(self.args.packets):
+            published += await self.step(timings)
+        await self.mqtt.flush()
+        elapsed = time.perf_counter() - start
+        spi = self.spi_counters()
+
+        allocations = None
+        if self.args.alloc_packets:
+            allocations = {stage: 0 for stage in STAGES}
+            tracemalloc.start()
+            for _ in range(self.args.alloc_packets):
+                await self.step(allocations=allocations)
+            tracemalloc.stop()
+        await self.mqtt.disconnect()
+        # let the cancelled reader and keepalive tasks run to their end
+        # before asyncio.run() returns
+        await asyncio.sleep(0)
+        return published, elapsed, spi, timings, allocations
+
+    def spi_counters(self):
+        return sum(s.transactions for s in self.sims), sum(s.bytes for s in self.sims)
+
+    def reset_counters(self):
+        for sim in self.sims:
+            sim.reset_counters()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--packets', type=int, default=1000, help='frames in the timed pass')
+    parser.add_argument('--alloc-packets', type=int, default=200,
+                        help='frames in the tracemalloc pass (0 to skip)')
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--size', type=int, default=64, help='frame length in bytes')
+    parser.add_argument('--radios', type=int, default=3, choices=(1, 2, 3),
+                        help='how many antennas hear each frame')
+    parser.add_argument('--rx', choices=('get_msg2', 'receive'), default='get_msg2',
+                        help='GroundStation.get_msg2 (wake path) or RFM9x.receive')
+    parser.add_argument('--qos', type=int, default=0, choices=(0, 1, 2))
+    parser.add_argument('--raw', action='store_true',
+                        help='publish the frame bytes instead of the JSON message')
+    parser.add_argument('--fs', default=os.path.join(emulate.HOST_DIR, '.circuitpy'))
+    parser.add_argument('--out', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    emulate.install(fs_root=args.fs)
+    import asyncio
+    sink = MQTTSink()
+    # station chatter (print() in the receive path) is part of the cost on
+    # the board too, but not something to put in the report
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        pipeline = Pipeline(args, sink.port)
+        published, elapsed, (transactions, spi_bytes), timings, allocations = \
+            asyncio.run(pipeline.run())
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    sink.close()
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('fs', 'out')},
+        'packets': args.packets,
+        'published': published,
+        'seconds': round(elapsed, 4),
+        'packets_per_sec': round(args.packets / elapsed, 1),
+        'spi_transactions_per_packet': round(transactions / args.packets, 2),
+        'spi_bytes_per_packet': round(spi_bytes / args.packets, 1),
+        'stages': {stage: percentiles(timings[stage]) for stage in STAGES},
+        'end_to_end': percentiles(timings['end_to_end']),
+        'peak_alloc_bytes': allocations,
+        'peak_alloc_bytes_max': max(allocations.values()) if allocations else None,
+        'broker_publishes': sink.publishes,
+        'broker_bytes': sink.bytes,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return report
+
+
+if __name__ == '__main__':
+    main()
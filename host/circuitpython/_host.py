@@ -0,0 +1,26 @@
+"""
+Emulator state shared by the stub modules.
+
+Nothing under code/ imports this; host/run.py and host/emulate.py set these
+to describe the environment the ground station is booted into.
+"""
+# wifi.radio.connect() succeeds
+wifi_available = True
+wifi_rssi = -60
+# battery voltage seen by analogio.AnalogIn on the divider pin
+battery_voltage = 3.9
+# storage.remount() refuses like it does when CIRCUITPY is mounted over USB
+usb_connected = False
+# CIRCUITPY is read-only to code.py until it remounts it
+fs_readonly = True
+# Deep/light sleep: wait for alarms in real time, or fire the earliest
+# TimeAlarm immediately when no PinAlarm is already active
+fast_sleep = False
+# Called whenever code polls a pin or sleeps, so simulated peripherals
+# running on the real clock (host/sx127x.py) can raise their IRQ lines
+tickers = []
+
+
+def tick():
+    for update in tickers:
+        update()
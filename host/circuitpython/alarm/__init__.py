@@ -0,0 +1,51 @@
+"""`alarm` stand-in.
+
+sleep_memory survives emulated deep sleep. exit_and_deep_sleep_until_alarms()
+raises DeepSleepRequest, which host/run.py turns into a reboot with
+wake_alarm set to whichever alarm fired.
+"""
+import time as _time
+
+import _host
+from . import pin, time
+
+sleep_memory = bytearray(8192)
+wake_alarm = None
+
+
+class DeepSleepRequest(BaseException):
+    """Emulator only: the program asked to deep sleep until one of alarms."""
+
+    def __init__(self, alarms):
+        super().__init__(alarms)
+        self.alarms = alarms
+
+
+def _fired(alarm):
+    if isinstance(alarm, pin.PinAlarm):
+        return alarm.pin.level == alarm.value
+    return _time.monotonic() >= alarm.monotonic_time
+
+
+def wait_until_alarms(*alarms):
+    """Emulator only: block until one of alarms fires and return it."""
+    while True:
+        _host.tick()
+        for alarm in alarms:
+            if _fired(alarm):
+                return alarm
+        if _host.fast_sleep:
+            timers = [a for a in alarms if isinstance(a, time.TimeAlarm)]
+            if timers:
+                return min(timers, key=lambda a: a.monotonic_time)
+        _time.sleep(0.001)
+
+
+def light_sleep_until_alarms(*alarms):
+    global wake_alarm
+    wake_alarm = wait_until_alarms(*alarms)
+    return wake_alarm
+
+
+def exit_and_deep_sleep_until_alarms(*alarms, preserve_dios=()):
+    raise DeepSleepRequest(alarms)
@@ -0,0 +1,11 @@
+"""`alarm.pin` stand-in"""
+
+
+class PinAlarm:
+    def __init__(self, pin, value, edge=False, pull=False):
+        if pin._owner is not None:
+            raise ValueError("{} in use".format(pin))
+        self.pin = pin
+        self.value = value
+        self.edge = edge
+        self.pull = pull
@@ -0,0 +1,12 @@
+"""`alarm.time` stand-in"""
+import time as _time
+
+
+class TimeAlarm:
+    def __init__(self, *, monotonic_time=None, epoch_time=None):
+        if (monotonic_time is None) == (epoch_time is None):
+            raise ValueError("Supply exactly one of monotonic_time or epoch_time")
+        if monotonic_time is None:
+            monotonic_time = _time.monotonic() + (epoch_time - _time.time())
+        self.monotonic_time = monotonic_time
+        self.epoch_time = epoch_time
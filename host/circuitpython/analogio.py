@@ -0,0 +1,19 @@
+"""`analogio` stand-in. Reads the battery divider voltage from _host."""
+import _host
+
+
+class AnalogIn:
+    reference_voltage = 3.3
+
+    def __init__(self, pin):
+        pin._claim(self)
+        self._pin = pin
+
+    def deinit(self):
+        self._pin._release()
+
+    @property
+    def value(self):
+        # the battery sits behind a 2:1 divider
+        raw = int(_host.battery_voltage / 2 / self.reference_voltage * 65536)
+        return max(0, min(65535, raw))
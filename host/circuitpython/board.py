@@ -0,0 +1,44 @@
+"""`board` stand-in laid out like the FeatherS2 as wired in this repo"""
+from microcontroller import Pin
+
+for _n in range(46):
+    globals()["IO{}".format(_n)] = Pin("IO{}".format(_n))
+del _n
+
+# aliases used by code/ for the radio CS/RST lines
+D5 = Pin("D5")
+D6 = Pin("D6")
+D12 = Pin("D12")
+D13 = Pin("D13")
+D20 = Pin("D20")
+D21 = Pin("D21")
+LED = Pin("LED")
+SCK = Pin("SCK")
+MOSI = Pin("MOSI")
+MISO = Pin("MISO")
+SDA = Pin("SDA")
+SCL = Pin("SCL")
+
+_spi = None
+
+
+def SPI():
+    """The board SPI bus, a singleton like on CircuitPython."""
+    global _spi
+    if _spi is None:
+        import busio
+        _spi = busio.SPI(SCK, MOSI=MOSI, MISO=MISO)
+    return _spi
+
+
+def _pins():
+    return [v for v in globals().values() if isinstance(v, Pin)]
+
+
+def _reset():
+    """Power-on state: every pin released (the SPI bus object survives so the
+    devices attached to it do too)."""
+    for pin in _pins():
+        pin._release()
+    if _spi is not None:
+        _spi._locked = False
@@ -0,0 +1,95 @@
+"""`busio` stand-in. SPI moves bytes between the MCU and emulated devices."""
+
+
+class SPI:
+    """SPI bus with CircuitPython's locking rules.
+
+    Emulated devices are attached with attach(cs_pin, device). A device is
+    selected while its CS pin is low and must provide select(), deselect()
+    and exchange(byte) -> byte.
+    """
+
+    def __init__(self, clock, MOSI=None, MISO=None):
+        self._locked = False
+        self._devices = {}
+        self._selected = []
+        self.frequency = 100000
+        self.polarity = 0
+        self.phase = 0
+
+    def deinit(self):
+        self._locked = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.deinit()
+
+    def attach(self, cs_pin, device):
+        """Emulator only: put device on the bus behind cs_pin."""
+        self._devices[cs_pin] = device
+        cs_pin.watch(self._cs_changed)
+
+    def _cs_changed(self, pin, level):
+        device = self._devices.get(pin)
+        if device is None:
+            return
+        if level:
+            if device in self._selected:
+                self._selected.remove(device)
+                device.deselect()
+        elif device not in self._selected:
+            self._selected.append(device)
+            device.select()
+
+    def try_lock(self):
+        if self._locked:
+            return False
+        self._locked = True
+        return True
+
+    def unlock(self):
+        self._locked = False
+
+    def configure(self, *, baudrate=100000, polarity=0, phase=0, bits=8):
+        self._check_lock()
+        self.frequency = baudrate
+        self.polarity = polarity
+        self.phase = phase
+
+    def _check_lock(self):
+        if not self._locked:
+            raise RuntimeError("Function requires lock")
+
+    def _exchange(self, byte):
+        result = 0xFF  # MISO floats high with nothing selected
+        for device in self._selected:
+            result &= device.exchange(byte)
+        return result
+
+    def write(self, buffer, *, start=0, end=None):
+        self._check_lock()
+        if end is None:
+            end = len(buffer)
+        for i in range(start, end):
+            self._exchange(buffer[i])
+
+    def readinto(self, buffer, *, start=0, end=None, write_value=0):
+        self._check_lock()
+        if end is None:
+            end = len(buffer)
+        for i in range(start, end):
+            buffer[i] = self._exchange(write_value)
+
+    def write_readinto(self, buffer_out, buffer_in, *, out_start=0, out_end=None,
+                       in_start=0, in_end=None):
+        self._check_lock()
+        if out_end is None:
+            out_end = len(buffer_out)
+        if in_end is None:
+            in_end = len(buffer_in)
+        if out_end - out_start != in_end - in_start:
+            raise ValueError("buffer slices must be of equal length")
+        for i in range(out_end - out_start):
+            buffer_in[in_start + i] = self._exchange(buffer_out[out_start + i])
@@ -0,0 +1,85 @@
+"""`digitalio` stand-in backed by microcontroller.Pin levels"""
+import _host
+
+
+class Direction:
+    INPUT = "INPUT"
+    OUTPUT = "OUTPUT"
+
+
+class Pull:
+    UP = "UP"
+    DOWN = "DOWN"
+
+
+class DriveMode:
+    PUSH_PULL = "PUSH_PULL"
+    OPEN_DRAIN = "OPEN_DRAIN"
+
+
+class DigitalInOut:
+    def __init__(self, pin):
+        pin._claim(self)
+        self._pin = pin
+        self._direction = Direction.INPUT
+        self.drive_mode = DriveMode.PUSH_PULL
+
+    def deinit(self):
+        if self._pin is not None:
+            self._pin._release()
+            self._pin = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.deinit()
+
+    def _check(self):
+        if self._pin is None:
+            raise ValueError("Object has been deinitialized and can no longer be used. Create a new object.")
+
+    def switch_to_output(self, value=False, drive_mode=DriveMode.PUSH_PULL):
+        self._check()
+        self._direction = Direction.OUTPUT
+        self.drive_mode = drive_mode
+        self._pin._set(output=bool(value), pull=None)
+
+    def switch_to_input(self, pull=None):
+        self._check()
+        self._direction = Direction.INPUT
+        self._pin._set(output=None, pull=pull)
+
+    @property
+    def direction(self):
+        return self._direction
+
+    @direction.setter
+    def direction(self, value):
+        if value == Direction.OUTPUT:
+            self.switch_to_output()
+        else:
+            self.switch_to_input()
+
+    @property
+    def value(self):
+        self._check()
+        _host.tick()
+        return self._pin.level
+
+    @value.setter
+    def value(self, value):
+        self._check()
+        if self._direction != Direction.OUTPUT:
+            raise AttributeError("Cannot set value when direction is input.")
+        self._pin._set(output=bool(value))
+
+    @property
+    def pull(self):
+        return self._pin._pull
+
+    @pull.setter
+    def pull(self, value):
+        if self._direction == Direction.OUTPUT:
+            raise AttributeError("Pull not used when direction is output.")
+        self._pin._set(pull=value)
@@ -0,0 +1,71 @@
+"""`microcontroller` stand-in: Pin, cpu and nvm"""
+
+
+class Pin:
+    """A named MCU pin. Tracks who has claimed it and its electrical level."""
+
+    def __init__(self, name):
+        self.name = name
+        self._owner = None
+        self._output = None  # level driven by the MCU, None when an input
+        self._external = None  # level driven by an attached device
+        self._pull = None
+        self._watchers = []
+
+    def __repr__(self):
+        return "board.{}".format(self.name)
+
+    @property
+    def level(self):
+        """Current electrical level of the pin."""
+        if self._output is not None:
+            return self._output
+        if self._external is not None:
+            return self._external
+        return self._pull == "UP"
+
+    def drive(self, level):
+        """Drive the pin from outside the MCU (e.g. a radio's DIO0 line).
+        Pass None to stop driving it."""
+        self._set(external=level)
+
+    def watch(self, callback):
+        """Call callback(pin, level) every time the level changes."""
+        self._watchers.append(callback)
+
+    def _claim(self, owner):
+        if self._owner is not None:
+            raise ValueError("{} in use".format(self))
+        self._owner = owner
+
+    def _release(self):
+        self._owner = None
+        self._set(output=None, pull=None)
+
+    def _set(self, **changes):
+        before = self.level
+        if "output" in changes:
+            self._output = changes["output"]
+        if "external" in changes:
+            self._external = changes["external"]
+        if "pull" in changes:
+            self._pull = changes["pull"]
+        after = self.level
+        if after != before:
+            for callback in self._watchers:
+                callback(self, after)
+
+
+class Processor:
+    uid = bytes(range(0x10, 0x20))
+    frequency = 240000000
+    temperature = 25.0
+    voltage = 3.3
+
+
+cpu = Processor()
+nvm = bytearray(8192)
+
+
+def reset():
+    raise SystemExit("microcontroller.reset()")
@@ -0,0 +1,13 @@
+"""`micropython` stand-in: the decorators and const() used by CircuitPython code"""
+
+
+def const(value):
+    return value
+
+
+def native(func):
+    return func
+
+
+def viper(func):
+    return func
@@ -0,0 +1,11 @@
+"""Development secrets, used when code/ has no secrets.py of its own"""
+secrets = {
+    'homeSSID': 'emulated',
+    'homePass': '',
+    'broker': 'localhost',
+    'port': 1883,
+    'data': 'pygs/data',
+    'status': 'pygs/status/',
+    'remote': 'pygs/remote/',
+    'pass': b'\x00\x00\x00\x00',
+}
@@ -0,0 +1,28 @@
+"""`socketpool` stand-in backed by the host's sockets"""
+import socket as _socket
+
+
+class SocketPool:
+    AF_INET = _socket.AF_INET
+    AF_INET6 = _socket.AF_INET6
+    SOCK_STREAM = _socket.SOCK_STREAM
+    SOCK_DGRAM = _socket.SOCK_DGRAM
+    SOCK_RAW = _socket.SOCK_RAW
+    IPPROTO_TCP = _socket.IPPROTO_TCP
+    EAI_NONAME = _socket.EAI_NONAME
+    gaierror = _socket.gaierror
+
+    def __init__(self, radio):
+        self._radio = radio
+
+    def _check(self):
+        if self._radio.ap_info is None:
+            raise OSError(113, "EHOSTUNREACH")
+
+    def socket(self, family=AF_INET, type=SOCK_STREAM, proto=0):
+        self._check()
+        return _socket.socket(family, type, proto)
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        self._check()
+        return _socket.getaddrinfo(host, port, family, type, proto, flags)
@@ -0,0 +1,14 @@
+"""`storage` stand-in. The read-only flag is enforced by host/emulate.py."""
+import _host
+
+
+def remount(mount_path, readonly=False, *, disable_concurrent_write_protection=False):
+    if mount_path != "/":
+        raise OSError(2, "No such file/directory")
+    if _host.usb_connected:
+        raise RuntimeError("Cannot remount '/' when visible via USB.")
+    _host.fs_readonly = bool(readonly)
+
+
+def getmount(mount_path):
+    return None
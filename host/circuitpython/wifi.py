@@ -0,0 +1,40 @@
+"""`wifi` stand-in. Connection success is controlled by _host.wifi_available."""
+import _host
+
+
+class Network:
+    def __init__(self, ssid):
+        self.ssid = ssid
+        self.bssid = b"\x00\x11\x22\x33\x44\x55"
+        self.channel = 6
+        self.country = "US"
+
+    @property
+    def rssi(self):
+        return _host.wifi_rssi
+
+
+class Radio:
+    def __init__(self):
+        self.enabled = True
+        self.ap_info = None
+        self.ipv4_address = None
+        self.hostname = "pygs"
+        self.mac_address = b"\x7c\xdf\xa1\x00\x00\x01"
+
+    def connect(self, ssid, password="", *, channel=0, bssid=None, timeout=None):
+        if not _host.wifi_available:
+            raise ConnectionError("No network with that ssid")
+        self.ap_info = Network(ssid)
+        self.ipv4_address = "127.0.0.1"
+
+    def stop_station(self):
+        self.ap_info = None
+        self.ipv4_address = None
+
+
+radio = Radio()
+
+
+def _reset():
+    radio.stop_station()
@@ -0,0 +1,45 @@
+"""
+Emulated SPI peripherals for busio.SPI.attach().
+"""
+
+
+class RegisterDevice:
+    """Generic SPI register file in the SX127x style: the first byte of a
+    transaction is the address (bit 7 set for a write), following bytes
+    read or write consecutive registers. Subclasses hook read_reg/write_reg.
+    """
+
+    def __init__(self, size=0x80, defaults=None):
+        self.regs = bytearray(size)
+        for address, value in (defaults or {}).items():
+            self.regs[address] = value
+        self._address = None
+        self._writing = False
+
+    def select(self):
+        self._address = None
+
+    def deselect(self):
+        self._address = None
+
+    def exchange(self, byte):
+        if self._address is None:
+            self._address = byte & 0x7F
+            self._writing = bool(byte & 0x80)
+            return 0
+        address = self._address
+        self._address = self.next_address(address)
+        if self._writing:
+            self.write_reg(address, byte)
+            return 0
+        return self.read_reg(address)
+
+    def next_address(self, address):
+        return (address + 1) % len(self.regs)
+
+    def read_reg(self, address):
+        return self.regs[address]
+
+    def write_reg(self, address, value):
+        self.regs[address] = value
+
@@ -0,0 +1,161 @@
+"""
+Make CPython look enough like a FeatherS2 running CircuitPython for the code
+in code/ to run unmodified.
+
+    import emulate
+    emulate.install(fs_root='host/.circuitpy')
+
+install() puts the hardware stand-ins from host/circuitpython on sys.path,
+loads the vendored asyncio from code/lib (patching the two MicroPython-isms
+it relies on), lets json.dumps() take bytes like MicroPython's does and, if
+fs_root is given, maps the absolute paths used by code/ ('/data.txt',
+'/sd/...') into that directory. Libraries that ship as
+.mpy in code/lib come from pip instead, see host/requirements.txt.
+"""
+import builtins
+import importlib
+import importlib.util
+import json
+import os
+import select
+import sys
+
+HOST_DIR = os.path.dirname(os.path.abspath(__file__))
+CODE_DIR = os.path.join(os.path.dirname(HOST_DIR), 'code')
+LIB_DIR = os.path.join(CODE_DIR, 'lib')
+STUB_DIR = os.path.join(HOST_DIR, 'circuitpython')
+
+
+def install(fs_root=None):
+    for path in (STUB_DIR, CODE_DIR):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    # code/lib goes last: its .mpy-only packages (adafruit_minimqtt) must not
+    # hide the pip installed ones
+    if LIB_DIR not in sys.path:
+        sys.path.append(LIB_DIR)
+    if not hasattr(select.poll(), 'ipoll'):
+        select.poll = _Poll
+    json.JSONEncoder.default = _json_default
+    install_asyncio()
+    if fs_root is not None:
+        install_fs(fs_root)
+
+
+def install_asyncio():
+    """Load code/lib/asyncio as the asyncio module, replacing any previous one."""
+    for name in [m for m in sys.modules if m == 'asyncio' or m.startswith('asyncio.')]:
+        del sys.modules[name]
+    path = os.path.join(LIB_DIR, 'asyncio')
+    spec = importlib.util.spec_from_file_location(
+        'asyncio', os.path.join(path, '__init__.py'), submodule_search_locations=[path])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['asyncio'] = module
+    spec.loader.exec_module(module)
+    # The package resolves these lazily through a MicroPython-only
+    # __import__ signature; resolve them up front instead.
+    for attr, submodule in module._attrs.items():
+        sub = importlib.import_module('asyncio.' + submodule)
+        if hasattr(sub, attr):
+            setattr(module, attr, getattr(sub, attr))
+    return module
+
+
+def _json_default(encoder, obj):
+    # MicroPython's json writes bytes out as a string (hexlify() results)
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.decode('latin-1')
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+class _Poll:
+    """select.poll with MicroPython's ipoll()"""
+
+    def __init__(self, poll=select.poll):
+        self._poll = poll()
+
+    def register(self, *args):
+        self._poll.register(*args)
+
+    def modify(self, *args):
+        self._poll.modify(*args)
+
+    def unregister(self, *args):
+        self._poll.unregister(*args)
+
+    def poll(self, timeout=None):
+        return self._poll.poll(timeout)
+
+    def ipoll(self, timeout=-1, flags=0):
+        return self._poll.poll(timeout)
+
+
+_real = {}
+
+
+def install_fs(root):
+    """Map file access made from code/ onto root, which plays the CIRCUITPY
+    drive (and /sd). Writes outside /sd fail while the drive is read-only."""
+    root = os.path.abspath(root)
+    os.makedirs(root, exist_ok=True)
+    import _host
+
+    def from_code(depth=2):
+        return sys._getframe(depth).f_code.co_filename.startswith(CODE_DIR)
+
+    def remap(path):
+        if isinstance(path, str) and not path.startswith(root):
+            return os.path.join(root, path.lstrip('/'))
+        return path
+
+    def check_writable(path):
+        if _host.fs_readonly and not path.startswith('/sd'):
+            raise OSError(30, 'Read-only filesystem')
+
+    if not _real:
+        _real['open'] = builtins.open
+        for name in ('remove', 'stat', 'listdir', 'rename', 'mkdir', 'rmdir'):
+            _real[name] = getattr(os, name)
+
+    def open_(file, mode='r', *args, **kwargs):
+        if from_code() and isinstance(file, str):
+            if any(c in mode for c in 'wax+'):
+                check_writable(file)
+            file = remap(file)
+        return _real['open'](file, mode, *args, **kwargs)
+
+    def wrap(name, writes):
+        real = _real[name]
+
+        def call(path='.', *args, **kwargs):
+            if from_code() and isinstance(path, str):
+                if writes:
+                    check_writable(path)
+                path = remap(path)
+                args = tuple(remap(a) for a in args)
+            return real(path, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+    builtins.open = open_
+    os.remove = wrap('remove', True)
+    os.rename = wrap('rename', True)
+    os.mkdir = wrap('mkdir', True)
+    os.rmdir = wrap('rmdir', True)
+    os.stat = wrap('stat', False)
+    os.listdir = wrap('listdir', False)
+
+
+def reboot():
+    """Drop all state held by code/ as a reset would. sleep_memory, the
+    filesystem and devices attached to the SPI bus are kept."""
+    for name, module in list(sys.modules.items()):
+        if (getattr(module, '__file__', None) or '').startswith(CODE_DIR):
+            del sys.modules[name]
+    import _host
+    import board
+    import wifi
+    board._reset()
+    wifi._reset()
+    _host.fs_readonly = True
+    install_asyncio()
@@ -0,0 +1,78 @@
+"""
+Boot code/code.py on the host, going round the deep sleep loop like the
+board does. Each radio is an SX1276 simulator on the SPI bus with its
+DIO0 and RST lines wired like the FeatherS2 ground station.
+
+    python host/run.py --boots 3 --fast-sleep
+    python host/run.py --boots 2 --packet 1:ffff0000c0ffee@5
+"""
+import argparse
+import binascii
+import os
+import runpy
+import time
+
+import emulate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--boots', type=int, default=1,
+                        help='number of boots (deep sleep cycles) to run')
+    parser.add_argument('--no-wifi', action='store_true', help='wifi.radio.connect() fails')
+    parser.add_argument('--usb', action='store_true',
+                        help='CIRCUITPY is mounted over USB, so storage.remount() fails')
+    parser.add_argument('--vbatt', type=float, default=3.9, help='battery voltage')
+    parser.add_argument('--fast-sleep', action='store_true',
+                        help="don't wait out TimeAlarms")
+    parser.add_argument('--fs', default=os.path.join(emulate.HOST_DIR, '.circuitpy'),
+                        help='directory standing in for the CIRCUITPY drive')
+    parser.add_argument('--packet', action='append', default=[], metavar='RADIO:HEX[@SECONDS]',
+                        help='put a frame on the air for radio 1-3, SECONDS after start')
+    args = parser.parse_args(argv)
+
+    emulate.install(fs_root=args.fs)
+    import _host
+    import alarm
+    import board
+    from sx127x import SX1276
+
+    _host.wifi_available = not args.no_wifi
+    _host.usb_connected = args.usb
+    _host.battery_voltage = args.vbatt
+    _host.fast_sleep = args.fast_sleep
+
+    spi = board.SPI()
+    radios = []
+    for cs, rst, dio0 in ((board.D5, board.D6, board.IO5),
+                          (board.D20, board.D21, board.IO6),
+                          (board.D12, board.D13, board.IO7)):
+        radio = SX1276(dio0=dio0, reset=rst)
+        spi.attach(cs, radio)
+        _host.tickers.append(radio.update)
+        radios.append(radio)
+
+    start = time.monotonic()
+    for packet in args.packet:
+        radio, _, frame = packet.partition(':')
+        frame, _, delay = frame.partition('@')
+        radios[int(radio) - 1].inject(binascii.unhexlify(frame), at=start + float(delay or 0))
+
+    for boot in range(args.boots):
+        print('--- boot {} (wake alarm: {}) ---'.format(boot, alarm.wake_alarm))
+        try:
+            runpy.run_path(os.path.join(emulate.CODE_DIR, 'code.py'), run_name='__main__')
+        except alarm.DeepSleepRequest as request:
+            alarm.wake_alarm = alarm.wait_until_alarms(*request.alarms)
+            emulate.reboot()
+        else:
+            print('Code done running.')
+            break
+
+    for n, radio in enumerate(radios, 1):
+        print('radio {}: {} SPI transactions, {} bytes, {} sent, {} missed'.format(
+            n, radio.transactions, radio.bytes, len(radio.transmitted), radio.missed))
+
+
+if __name__ == '__main__':
+    main()
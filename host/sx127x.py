@@ -0,0 +1,314 @@
+"""
+Register-level SX1276 (RFM95/96) simulator for busio.SPI.attach().
+
+Models the parts of the chip the drivers in code/ touch: the LoRa/FSK
+register pages, the FIFO and its pointers, OP_MODE transitions, IRQ flags
+(write 1 to clear), DIO0 mapping, the reset line, RX_NB_BYTES, PKT_RSSI,
+PKT_SNR and MODEM_STAT. Packets are injected with inject() and land in the FIFO once their
+time on air has passed on the simulator's clock, if the radio is listening.
+
+    clock = VirtualClock()
+    radio = SX1276(clock=clock, dio0=board.IO5, reset=board.D6)
+    board.SPI().attach(board.D5, radio)
+    radio.inject(b'\\xff\\xff\\x00\\x00hello', rssi=-92)
+    clock.advance(0.1)
+
+Every SPI transaction and byte is counted (transactions, bytes) so driver
+overhead per packet can be measured.
+"""
+import math
+import time
+
+from devices import RegisterDevice
+
+FIFO = 0x00
+OP_MODE = 0x01
+FIFO_ADDR_PTR = 0x0D
+FIFO_TX_BASE_ADDR = 0x0E
+FIFO_RX_BASE_ADDR = 0x0F
+FIFO_RX_CURRENT_ADDR = 0x10
+IRQ_FLAGS = 0x12
+RX_NB_BYTES = 0x13
+RX_PACKET_CNT_MSB = 0x16
+RX_PACKET_CNT_LSB = 0x17
+MODEM_STAT = 0x18
+PKT_SNR_VALUE = 0x19
+PKT_RSSI_VALUE = 0x1A
+MODEM_CONFIG1 = 0x1D
+MODEM_CONFIG2 = 0x1E
+PREAMBLE_MSB = 0x20
+PREAMBLE_LSB = 0x21
+PAYLOAD_LENGTH = 0x22
+FIFO_RX_BYTE_ADDR = 0x25
+MODEM_CONFIG3 = 0x26
+DIO_MAPPING1 = 0x40
+VERSION = 0x42
+FSK_IRQ_FLAGS2 = 0x3F
+
+SLEEP = 0
+STANDBY = 1
+TX = 3
+RX_CONTINUOUS = 5
+RX_SINGLE = 6
+
+IRQ_RX_TIMEOUT = 0x80
+IRQ_RX_DONE = 0x40
+IRQ_PAYLOAD_CRC_ERROR = 0x20
+IRQ_VALID_HEADER = 0x10
+IRQ_TX_DONE = 0x08
+
+BANDWIDTHS = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000, 500000)
+
+# Power-on values of the registers the drivers read back (LoRa page where
+# the pages differ)
+DEFAULTS = {
+    OP_MODE: 0x09, 0x06: 0x6C, 0x07: 0x80, 0x09: 0x4F, 0x0A: 0x09, 0x0B: 0x2B,
+    0x0C: 0x20, FIFO_TX_BASE_ADDR: 0x80, MODEM_CONFIG1: 0x72, MODEM_CONFIG2: 0x70,
+    0x1F: 0x64, PREAMBLE_LSB: 0x08, PAYLOAD_LENGTH: 0x01, 0x23: 0xFF,
+    MODEM_CONFIG3: 0x04, 0x31: 0xC3, 0x37: 0x0A, VERSION: 0x12, 0x4D: 0x84,
+}
+
+
+class VirtualClock:
+    """A clock that only moves when told to. Simulators using it are updated
+    every time it advances, so DIO0 lines rise without any SPI traffic."""
+
+    def __init__(self, start=0.0):
+        self.now = start
+        self._listeners = []
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+        for update in self._listeners:
+            update()
+
+    def watch(self, update):
+        self._listeners.append(update)
+
+
+class SX1276(RegisterDevice):
+    """
+    clock: zero argument callable returning seconds, time.monotonic by default
+    dio0, reset: board pins wired to DIO0 and RST, optional
+    time_on_air: callable(payload_length) -> seconds, overriding the LoRa
+        formula computed from the modem registers
+    high_frequency: RF port used for PKT_RSSI (-157 dBm offset instead of -164)
+    """
+
+    def __init__(self, *, clock=time.monotonic, dio0=None, reset=None,
+                 time_on_air=None, high_frequency=False):
+        super().__init__(defaults=DEFAULTS)
+        self.clock = clock
+        self.dio0 = dio0
+        self.fifo = bytearray(256)
+        # registers 0x0D-0x3F of the FSK/OOK page
+        self._fsk = bytearray(0x40)
+        self._time_on_air = time_on_air
+        self._rssi_offset = 157 if high_frequency else 164
+        self._tx_end = None
+        self._incoming = []
+        # packets put on the air by the driver: (time, bytes)
+        self.transmitted = []
+        # packets that arrived while not listening / on top of an unread one
+        self.missed = 0
+        self.overruns = 0
+        self.transactions = 0
+        self.bytes = 0
+        if hasattr(clock, 'watch'):
+            clock.watch(self.update)
+        if reset is not None:
+            # the module pulls NRESET up, so it stays high while the MCU
+            # isn't driving it (e.g. in deep sleep)
+            reset.drive(True)
+            reset.watch(self._reset_changed)
+
+    # -- bookkeeping -------------------------------------------------------
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes = 0
+
+    def reset(self):
+        """Power-on reset: registers back to defaults, FIFO and IRQs cleared."""
+        self.regs[:] = bytes(len(self.regs))
+        for address, value in DEFAULTS.items():
+            self.regs[address] = value
+        self._fsk[:] = bytes(len(self._fsk))
+        self._tx_end = None
+        self._update_dio0()
+
+    def _reset_changed(self, pin, level):
+        if not level:
+            self.reset()
+
+    @property
+    def lora(self):
+        return bool(self.regs[OP_MODE] & 0x80)
+
+    @property
+    def mode(self):
+        return self.regs[OP_MODE] & 0x07
+
+    # -- packets -----------------------------------------------------------
+
+    def time_on_air(self, length):
+        """Seconds to send a length byte payload with the current modem settings."""
+        if self._time_on_air is not None:
+            return self._time_on_air(length)
+        bw_id = self.regs[MODEM_CONFIG1] >> 4
+        bw = BANDWIDTHS[min(bw_id, len(BANDWIDTHS) - 1)]
+        cr = (self.regs[MODEM_CONFIG1] >> 1) & 0x07
+        implicit = self.regs[MODEM_CONFIG1] & 0x01
+        sf = max(6, self.regs[MODEM_CONFIG2] >> 4)
+        crc = (self.regs[MODEM_CONFIG2] >> 2) & 0x01
+        ldro = (self.regs[MODEM_CONFIG3] >> 3) & 0x01
+        preamble = (self.regs[PREAMBLE_MSB] << 8) | self.regs[PREAMBLE_LSB]
+        t_sym = (1 << sf) / bw
+        symbols = math.ceil((8 * length - 4 * sf + 28 + 16 * crc - 20 * implicit)
+                            / (4 * (sf - 2 * ldro))) * (cr + 4)
+        return (preamble + 4.25) * t_sym + (8 + max(symbols, 0)) * t_sym
+
+    def inject(self, data, *, rssi=-90, snr=8.0, crc_ok=True, at=None):
+        """Start a packet on the air at time at (now by default). It is
+        delivered once its time on air has passed, in the order started."""
+        start = self.clock() if at is None else at
+        self._incoming.append((start, bytes(data), rssi, snr, crc_ok))
+        self._incoming.sort(key=lambda p: p[0])
+        self.update()
+
+    def update(self):
+        """Complete whatever the clock says has finished: transmissions and
+        packets arriving."""
+        now = self.clock()
+        if self._tx_end is not None and now >= self._tx_end:
+            self._tx_end = None
+            self._finish_tx()
+        # time on air follows the modem settings the packet is received with
+        while self._incoming and self._incoming[0][0] + self.time_on_air(len(self._incoming[0][1])) <= now:
+            self._receive(*self._incoming.pop(0)[1:])
+
+    def _finish_tx(self):
+        length = self.regs[PAYLOAD_LENGTH]
+        start = self.regs[FIFO_TX_BASE_ADDR]
+        self.transmitted.append((self.clock(), bytes(self.fifo[(start + i) % 256] for i in range(length))))
+        self.regs[OP_MODE] = (self.regs[OP_MODE] & ~0x07) | STANDBY
+        if self.lora:
+            self.regs[IRQ_FLAGS] |= IRQ_TX_DONE
+        else:
+            self._fsk[FSK_IRQ_FLAGS2] |= 0x48  # FifoEmpty | PacketSent
+        self._update_dio0()
+
+    def _receive(self, data, rssi, snr, crc_ok):
+        if not self.lora or self.mode not in (RX_CONTINUOUS, RX_SINGLE):
+            self.missed += 1
+            return
+        if self.regs[IRQ_FLAGS] & IRQ_RX_DONE:
+            self.overruns += 1
+        start = self.regs[FIFO_RX_BYTE_ADDR]
+        for i, byte in enumerate(data):
+            self.fifo[(start + i) % 256] = byte
+        self.regs[FIFO_RX_CURRENT_ADDR] = start
+        self.regs[FIFO_RX_BYTE_ADDR] = (start + len(data)) % 256
+        self.regs[RX_NB_BYTES] = len(data)
+        self.regs[PKT_RSSI_VALUE] = max(0, min(255, rssi + self._rssi_offset))
+        self.regs[PKT_SNR_VALUE] = int(snr * 4) & 0xFF
+        count = ((self.regs[RX_PACKET_CNT_MSB] << 8) | self.regs[RX_PACKET_CNT_LSB]) + 1
+        self.regs[RX_PACKET_CNT_MSB] = (count >> 8) & 0xFF
+        self.regs[RX_PACKET_CNT_LSB] = count & 0xFF
+        self.regs[IRQ_FLAGS] |= IRQ_RX_DONE | IRQ_VALID_HEADER
+        if not crc_ok:
+            self.regs[IRQ_FLAGS] |= IRQ_PAYLOAD_CRC_ERROR
+        if self.mode == RX_SINGLE:
+            self.regs[OP_MODE] = (self.regs[OP_MODE] & ~0x07) | STANDBY
+        self._update_dio0()
+
+    def _update_dio0(self):
+        if self.dio0 is None:
+            return
+        mapping = self.regs[DIO_MAPPING1] >> 6
+        flags = self.regs[IRQ_FLAGS]
+        if mapping == 0:
+            level = bool(flags & IRQ_RX_DONE)
+        elif mapping == 1:
+            level = bool(flags & IRQ_TX_DONE)
+        else:
+            level = False
+        self.dio0.drive(level)
+
+    # -- SPI ---------------------------------------------------------------
+
+    def select(self):
+        super().select()
+        self.transactions += 1
+        self.update()
+
+    def exchange(self, byte):
+        self.bytes += 1
+        return super().exchange(byte)
+
+    def next_address(self, address):
+        # burst access to the FIFO stays on the FIFO register
+        return address if address == FIFO else super().next_address(address)
+
+    def _page(self, address):
+        if 0x0D <= address <= 0x3F and not self.lora:
+            return self._fsk
+        return self.regs
+
+    def read_reg(self, address):
+        if address == FIFO:
+            ptr = self.regs[FIFO_ADDR_PTR]
+            self.regs[FIFO_ADDR_PTR] = (ptr + 1) % 256
+            return self.fifo[ptr]
+        if address == MODEM_STAT and self.lora:
+            return self._modem_stat()
+        return self._page(address)[address]
+
+    def _modem_stat(self):
+        # signal detected, synchronized, RX ongoing and header valid while a
+        # packet is on the air and we are listening, else modem clear
+        if self.mode in (RX_CONTINUOUS, RX_SINGLE) and self._incoming \
+                and self._incoming[0][0] <= self.clock():
+            return 0x0F
+        return 0x10
+
+    def write_reg(self, address, value):
+        if address == FIFO:
+            ptr = self.regs[FIFO_ADDR_PTR]
+            self.fifo[ptr] = value
+            self.regs[FIFO_ADDR_PTR] = (ptr + 1) % 256
+        elif address == OP_MODE:
+            self._write_op_mode(value)
+        elif address == IRQ_FLAGS and self.lora:
+            self.regs[IRQ_FLAGS] &= ~value
+            self._update_dio0()
+        elif address == VERSION:
+            pass
+        elif address in (FIFO_RX_CURRENT_ADDR, RX_NB_BYTES, MODEM_STAT, PKT_SNR_VALUE,
+                         PKT_RSSI_VALUE, FIFO_RX_BYTE_ADDR) and self.lora:
+            pass  # read-only
+        else:
+            self._page(address)[address] = value
+            if address == DIO_MAPPING1:
+                self._update_dio0()
+
+    def _write_op_mode(self, value):
+        old = self.regs[OP_MODE]
+        if (old & 0x07) != SLEEP:
+            # LongRangeMode can only change in sleep
+            value = (value & ~0x80) | (old & 0x80)
+        self.regs[OP_MODE] = value
+        mode = value & 0x07
+        if mode == TX and (old & 0x07) != TX:
+            if self.lora:
+                self.regs[FIFO_ADDR_PTR] = self.regs[FIFO_TX_BASE_ADDR]
+                self._tx_end = self.clock() + self.time_on_air(self.regs[PAYLOAD_LENGTH])
+            else:
+                self._tx_end = self.clock()
+        elif mode != TX:
+            self._tx_end = None
+        if mode in (RX_CONTINUOUS, RX_SINGLE) and (old & 0x07) not in (RX_CONTINUOUS, RX_SINGLE):
+            self.regs[FIFO_RX_BYTE_ADDR] = self.regs[FIFO_RX_BASE_ADDR]
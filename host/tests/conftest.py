@@ -0,0 +1,9 @@
+import code  # noqa: F401  the stdlib one (pdb needs it), before code/ shadows it
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import emulate  # noqa: E402
+
+emulate.install()
@@ -0,0 +1,82 @@
+import board
+import digitalio
+import pytest
+
+import emulate
+from sx127x import SX1276, VirtualClock
+
+FREQ = 437.4
+
+
+@pytest.fixture
+def radio():
+    import pycubed_rfm9x
+
+    clock = VirtualClock()
+    sim = SX1276(clock=clock, reset=board.D6)
+    board.SPI().attach(board.D5, sim)
+    radio = pycubed_rfm9x.RFM9x(board.SPI(), digitalio.DigitalInOut(board.D5),
+                                digitalio.DigitalInOut(board.D6), FREQ, shadow_registers=True)
+    radio.name = 1
+    radio.listen()
+    writes = []
+    write_reg = sim.write_reg
+
+    def record(address, value):
+        if 0x06 <= address <= 0x08:
+            writes.append((clock(), address, value))
+        write_reg(address, value)
+    sim.write_reg = record
+    yield radio, sim, clock, writes
+    emulate.reboot()
+
+
+def frf_of(sim):
+    return (sim.regs[0x06] << 16) | (sim.regs[0x07] << 8) | sim.regs[0x08]
+
+
+def test_no_retune_while_a_packet_is_coming_in(radio):
+    from core.doppler import DopplerTracker
+    from core.frequency import FrequencyPlan, frf
+    radio, sim, clock, writes = radio
+    center = frf(FREQ)
+    tracker = DopplerTracker([radio], FREQ, [0, 10], FrequencyPlan([center, center + 200]), 100)
+    tracker.update(0)
+
+    sim.inject(b'\xff\xff\x00\x00' + bytes(40), at=9)
+    toa = sim.time_on_air(44)
+    clock.advance(9 + toa / 2)
+    assert radio.receiving()
+    del writes[:]
+    # time for the next plan entry, but the packet is still on the air
+    while clock() < 9 + toa:
+        tracker.update(10)
+        assert not writes
+        clock.advance(toa / 10)
+    assert radio.rx_done()
+    assert radio.read_fifo()[0] is not None
+
+    tracker.update(10)
+    assert writes and all(t >= 9 + toa for t, _, _ in writes)
+    assert frf_of(sim) == center + 200
+
+    tracker.restore()
+    assert frf_of(sim) == center
+
+
+class Ramp:
+    '''Station stand-in: the Doppler shift falls linearly over the pass'''
+
+    def doppler(self, orbit, t, freq):
+        return 10000 - 20000 * t / 600
+
+
+def test_retunes_only_past_the_tolerance():
+    from core.doppler import DopplerTracker
+    from pycubed_rfm9x import _RH_RF95_FSTEP
+    tracker = DopplerTracker.for_pass([], FREQ, None, Ramp(), 0, 600, bw=125000, tolerance=0.05)
+    plan = [tracker.plan[i] for i in range(len(tracker.plan))]
+    slack = 0.05 * 125000 / _RH_RF95_FSTEP
+    # a 20 kHz sweep in steps just over 6.25 kHz, not one per 61 Hz
+    assert 3 <= len(plan) <= 5
+    assert all(abs(b - a) > slack - 1 for a, b in zip(plan, plan[1:]))
@@ -0,0 +1,48 @@
+from core.diversity import Frame
+from core.sleep_log import SleepLog
+
+START = 24
+# 6 index bytes, then a 70 byte ring
+MEMORY = START + 6 + 70
+
+
+def frame(fill, length):
+    return Frame(bytes((fill,)) * length, 1, -90, (1, 2), True, 1000 + fill)
+
+
+def test_record_ending_at_the_end_of_the_ring_survives_a_wake():
+    memory = bytearray(MEMORY)
+    log = SleepLog(memory, START)
+    # 7 byte headers: two 35 byte records fill the ring exactly
+    assert log.append(frame(1, 28))
+    assert log.append(frame(2, 28))
+    log.drop(1)
+    # wraps to the start, in front of the head
+    assert log.append(frame(3, 24))
+    # the oldest record left ended at the end of the ring
+    log.drop(1)
+
+    # a deep sleep wake builds a new log over the same memory
+    log = SleepLog(memory, START)
+    assert [f.data for f in log.frames()] == [bytes((3,)) * 24]
+    assert log.append(frame(4, 10))
+    assert [f.data[0] for f in SleepLog(memory, START).frames()] == [3, 4]
+
+
+def test_head_at_the_end_of_the_ring_is_not_corrupt():
+    # as left by drop() before it wrapped the head itself
+    memory = bytearray(MEMORY)
+    log = SleepLog(memory, START)
+    assert log.append(frame(1, 24))
+    assert log.append(frame(2, 10))
+    memory[START:START + 6] = (70).to_bytes(2, 'big') + (48).to_bytes(2, 'big') + (2).to_bytes(2, 'big')
+
+    log = SleepLog(memory, START)
+    assert len(log) == 2
+    assert [f.data[0] for f in log.frames()] == [1, 2]
+
+
+def test_out_of_range_index_is_cleared():
+    memory = bytearray(MEMORY)
+    memory[START:START + 6] = (71).to_bytes(2, 'big') + (0).to_bytes(2, 'big') + (1).to_bytes(2, 'big')
+    assert len(SleepLog(memory, START)) == 0